@@ -0,0 +1,62 @@
+"""
+Admission control for expensive queries.
+"""
+
+import time
+
+# Use gevent sleeping if available, since the backend normally runs in gevent
+# greenlets under uWSGI.
+try:
+    import gevent
+    _sleep = gevent.sleep
+except ImportError:
+    _sleep = time.sleep
+
+class AdmissionControl:
+    """
+    Per-process budget for the estimated cost of the view results being
+    computed at once (see Querier.view_cost()), so that a few expensive
+    queries cannot take up all of a process while other requests wait behind
+    them. A request whose cost would go over the budget waits for others to
+    finish, and is turned away if it has waited too long. A request is always
+    admitted when nothing else is running, however expensive it is, since the
+    cost of single views is limited separately.
+    """
+
+    def __init__(self, budget, wait_timeout=5.0, poll_interval=0.05):
+        self.budget = budget
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.in_flight_cost = 0
+        self.num_in_flight = 0
+        self.counters = {'admitted': 0, 'waited': 0, 'rejected': 0}
+
+    def _fits(self, cost):
+        return self.num_in_flight == 0 or self.in_flight_cost + cost <= self.budget
+
+    def admit(self, cost):
+        """
+        Tries to start work of an estimated cost, waiting for other work to
+        finish if needed. Returns True if admitted, in which case release()
+        must be called with the same cost once the work is done (or has
+        failed). Returns False if the work did not fit in the budget in time.
+        """
+        if not self._fits(cost):
+            self.counters['waited'] += 1
+            deadline = time.time() + self.wait_timeout
+            while not self._fits(cost):
+                if time.time() >= deadline:
+                    self.counters['rejected'] += 1
+                    return False
+                _sleep(self.poll_interval)
+        self.in_flight_cost += cost
+        self.num_in_flight += 1
+        self.counters['admitted'] += 1
+        return True
+
+    def release(self, cost):
+        """
+        Finishes work started with admit().
+        """
+        self.in_flight_cost -= cost
+        self.num_in_flight -= 1
@@ -15,8 +15,16 @@ import tarfile
 import whoosh
 import whoosh.index
 import queries
+import indexcolumns
+import querycache
+import admission
+import searchers
+import executor
+import partitions
+import responseencoding
 
 import click
+import redis
 import requests
 
 from werkzeug.wrappers import BaseRequest
@@ -33,7 +41,7 @@ except ImportError:
 # import backend_settings
 # import backend_settings_defaults
 # handles which domain to choose based on environment variables internally
-from domain_config import domain_config
+from domain_config import domain_config, defaults
 
 # TODO: Also output to stdout when not running in Docker
 logger = logging.getLogger("query-logger")
@@ -78,21 +86,93 @@ def create_app(index, redis_address, redis_port):
     except whoosh.index.EmptyIndexError:
         logger.error("No index found at {}".format(index))
         sys.exit(1)
-    cache = RedisCache(redis_address, port=redis_port, default_timeout=0,
-                       key_prefix="query_cache")
-    querier = queries.Querier(whoosh_index, cache,
+    server_settings = dict(defaults.settings['server'])
+    server_settings.update(domain_config.settings.get('server', {}))
+    redis_client = redis.StrictRedis(host=redis_address, port=redis_port)
+
+    def make_cache(redis_client):
+        """
+        Makes a query cache with a local tier in front of the shared Redis
+        cache, for this process or a query worker process.
+        """
+        shared_cache = RedisCache(redis_client, default_timeout=0,
+                                  key_prefix="query_cache")
+        return querycache.TieredCache(shared_cache,
+                                      server_settings['local_cache_bytes'])
+
+    cache = make_cache(redis_client)
+    searcher_pool = searchers.SearcherPool(whoosh_index,
+                                           check_interval=server_settings['index_check_interval'])
+    query_parser = queries.make_query_parser(whoosh_index.schema)
+    cache.set_index_identity(searcher_pool.identity())
+    flights = querycache.SingleFlight(cache, redis_client,
+                                      lease=server_settings['single_flight_lease'],
+                                      wait_timeout=server_settings['single_flight_wait_timeout'])
+    admission_control = admission.AdmissionControl(server_settings['process_cost_budget'],
+                                                   wait_timeout=server_settings['admission_wait_timeout'])
+    columns = indexcolumns.ColumnStore()
+    partition_pool = partitions.PartitionPool(server_settings['query_partition_processes'],
+                                              min_partition_docs=server_settings['min_partition_docs'])
+    querier = queries.Querier(whoosh_index, cache, columns=columns,
+                              searchers=searcher_pool,
+                              query_parser=query_parser,
+                              partition_pool=partition_pool,
                               **domain_config.settings.get('querier', {})) # noqa
 
     querier.prime()
 
+    def register_partitioned_columns(previous_columns=None):
+        """
+        Registers the columns of the current version of the index for the
+        partition workers, first building the ones the previous version had.
+        Processes serving requests (such as uWSGI workers forked from this
+        one) fork partition workers of their own when first needed.
+        """
+        with searcher_pool.searcher() as searcher:
+            reader = searcher.reader()
+            index_columns = columns.for_reader(reader)
+            if previous_columns is not None:
+                index_columns.build_like(reader, index, previous_columns)
+            partition_pool.register(index_columns)
+        return index_columns
+
+    # In a list so the handler can change it
+    partitioned_columns = [register_partitioned_columns()]
+
+    # The worker processes start on first use, after priming, so they start
+    # with the primed columns
+    query_executor = None
+    if server_settings['query_worker_processes'] > 0:
+        query_executor = executor.QueryExecutor(index, server_settings['query_worker_processes'],
+                                                domain_config.settings.get('querier', {}),
+                                                columns=columns,
+                                                make_cache=lambda: make_cache(redis.StrictRedis(host=redis_address, port=redis_port)))
+
+    # Number of requests handled, in a list so the handler can change it
+    num_requests = [0]
+
     @QueryRequest.application
     def application(request):
+        # Switch to a new version of the index if there is one, and make
+        # sure cached results are for it
+        index_identity = searcher_pool.refresh()
+        cache.set_index_identity(index_identity)
+        if partition_pool.num_processes > 1 and index_identity != partitioned_columns[0].identity:
+            partitioned_columns[0] = register_partitioned_columns(partitioned_columns[0])
+
         email = request.cookies.get("email", "no-email")
         tracking_code = request.cookies.get("tracking", "")
         log_tracker = '[' + email + ' ' + tracking_code + ']'
 
         querier = queries.Querier(whoosh_index, cache,
                                   tracking_code=log_tracker,
+                                  columns=columns,
+                                  flights=flights,
+                                  admission=admission_control,
+                                  searchers=searcher_pool,
+                                  query_parser=query_parser,
+                                  executor=query_executor,
+                                  partition_pool=partition_pool,
                                   **domain_config.settings.get('querier', {}))
 
         try:
@@ -102,10 +182,26 @@ def create_app(index, redis_address, redis_port):
             return Response('{ "status": "error", "message": "invalid json" }',
                             mimetype='application/json', status=400)
 
-        query_response = querier.handle(query)
-
-        response = Response(json.dumps(query_response),
-                            mimetype='application/json')
+        if responseencoding.wants_encoding(request.args, request.headers):
+            response = Response(responseencoding.encode(querier.handle(query), variants='variants' in query),
+                                mimetype=responseencoding.mimetype)
+        elif query.get('progressive', False):
+            # Stream each stage of the response as a line of JSON as soon as
+            # it is ready
+            response = Response((json.dumps(stage) + '\n' for stage in querier.handle_progressive(query)),
+                                mimetype='application/x-ndjson')
+        else:
+            response = Response(json.dumps(querier.handle(query)),
+                                mimetype='application/json')
+
+        num_requests[0] += 1
+        if num_requests[0] % server_settings['cache_stats_log_interval'] == 0:
+            logger.info("query cache stats: %s" % (json.dumps(cache.stats())))
+            logger.info("query coalescing stats: %s" % (json.dumps(flights.counters)))
+            logger.info("query admission stats: %s" % (json.dumps(admission_control.counters)))
+            if query_executor is not None:
+                logger.info("query executor stats: %s" % (json.dumps(query_executor.stats())))
+            logger.info("query partitioning stats: %s" % (json.dumps(partition_pool.counters)))
         response.headers.add('Access-Control-Allow-Origin', '*')
 
         return response
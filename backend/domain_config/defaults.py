@@ -10,7 +10,27 @@ settings = {
     # Force a complete reset (clearing caches) at each settings reload (versus only if the Whoosh index changed)
     'always_reset': False,
     # Verbose logging output to standard error
-    'verbose': False
+    'verbose': False,
+    # Maximum total (pickled) size in bytes of query results cached locally in each backend process, in front of the shared Redis cache
+    'local_cache_bytes': 64 * 1024 * 1024,
+    # Number of requests between logging query cache statistics
+    'cache_stats_log_interval': 1000,
+    # Seconds that a backend process computing an uncached view result holds the lock making other processes wait for it instead of computing it too
+    'single_flight_lease': 10.0,
+    # Maximum seconds to wait for a view result being computed by another request before computing it anyway
+    'single_flight_wait_timeout': 30.0,
+    # Maximum total estimated cost (see max_view_cost) of the view results computed at once in each backend process
+    'process_cost_budget': 100000000,
+    # Maximum seconds a request waits for its views to fit in the process cost budget before getting a server busy error
+    'admission_wait_timeout': 5.0,
+    # Minimum seconds between checks for a new generation of the index to switch the shared searchers to
+    'index_check_interval': 1.0,
+    # Number of worker processes each backend process computes uncached view results in, so that they do not hold up its other requests (0 to compute them in the backend process)
+    'query_worker_processes': 0,
+    # Number of worker processes each backend process splits the counting for a single query between, by partitions of the document numbers (0 or 1 to count in the backend process; not used within query worker processes)
+    'query_partition_processes': 0,
+    # Minimum number of documents in each partition counted by a separate process, so that an index is only partitioned if it has at least twice as many documents (lower it for smaller indexes)
+    'min_partition_docs': 100000
   },
   'querier': {
     # All possible predicate argument numbers
@@ -23,18 +43,52 @@ settings = {
     'num_initial_description_pages_to_cache': 10,
     # Size of the cache for result pagination (cached results for pagination done on the backend
     'result_pagination_cache_size': 100,
+    # Number of per-constraint document masks to keep in memory (per index generation)
+    'constraint_cache_size': 200,
+    # Size in degrees of the cells of the grid index over event points used for geobox and geopolygon constraints
+    'geo_grid_cell_degrees': 1.0,
+    # Number of cells along the longer side of the grid index over t-SNE coordinates used for tsnePolygon constraints
+    'tsne_grid_cells': 256,
     # Names of fields to prime the cache with
     'fields_to_prime': [],
     # Names of fields to use for text searches if no fields are specified in the query
     'fields_for_text_searches': [],
     # Number of events on a page of count by field value results
     'count_by_field_value_page_size': 50,
+    # Maximum number of the most frequent values to keep in a count by field value result (for fields with many distinct values)
+    'count_by_field_value_max_values': 10000,
     # Number of events on a page of count by year results
     'count_by_year_page_size': 50,
     # Number of events on a page of reference point links results
     'referencepointlinks_page_size': 50,
     # Maximum number of co-occurring entities to include in plottimeline results
     'plottimeline_max_cooccurring_entities': 10,
+    # Seconds before cached plottimeline results under constraints expire, since every combination of constraints is cached (0 to keep them)
+    'constrained_plottimeline_cache_timeout': 24 * 60 * 60,
+    # Maximum number of individual points in a tsnecoordinates viewport result before points are binned, and of texts in a tsnetext result
+    'tsne_max_points': 5000,
+    # Maximum zoom level for binning tsnecoordinates viewport results (the grid has 2^zoom bins on each side)
+    'tsne_max_zoom': 12,
+    # Maximum number of values in a suggestions result
+    'suggestion_limit': 10,
+    # Maximum edit distance of fuzzy suggestions from the typed prefix (0 for prefix completion only)
+    'suggestion_max_edits': 1,
+    # Minimum length of a typed prefix before fuzzy suggestions are looked for
+    'suggestion_fuzzy_min_length': 3,
+    # Maximum number of lexicon values to consider as fuzzy suggestions for one prefix
+    'suggestion_max_fuzzy_candidates': 1000,
+    # Maximum estimated cost of computing a view for a constrained query (about the number of matching events times a weight for the view type), or None for no limit
+    'max_view_cost': 50000000,
+    # Maximum seconds to spend going through matching events for a view before returning a partial result, or None for no limit
+    'view_time_limit': 10.0,
+    # Maximum seconds to spend searching for the events matching a constraint before giving up with an error, or None for no limit
+    'constraint_time_limit': 10.0,
+    # Minimum number of matching events for progressive queries to send estimated counts before the exact ones
+    'progressive_min_matches': 50000,
+    # Number of matching events to sample for the estimated counts of progressive queries
+    'progressive_sample_size': 5000,
+    # Number of strata (ranges of consecutive matching events) the sample for estimated counts is spread over
+    'progressive_num_strata': 16,
     # Verbose logging output to standard error
     'verbose': False
   }
@@ -0,0 +1,63 @@
+"""
+Estimates of view results from a sample of the matching documents, for
+progressive query results.
+"""
+
+import numpy
+
+# Normal quantile for the 95% confidence intervals of estimates
+confidence_z = 1.96
+
+class StratifiedSample:
+    """
+    Stratified random sample of a set of matching documents. The increasing
+    document numbers of the matches are split into strata of consecutive
+    matches (so each stratum covers a range of the index, which tends to hold
+    similar events) and the same fraction of each stratum is sampled. The
+    sample is seeded, so the same matches always give the same estimates.
+    """
+
+    def __init__(self, docnums, sample_size, num_strata, seed=0):
+        random_state = numpy.random.RandomState(seed)
+        fraction = min(1.0, float(sample_size) / max(1, len(docnums)))
+        self.num_matches = len(docnums)
+        # List of (stratum size, sampled document numbers) pairs
+        self.strata = []
+        for stratum in numpy.array_split(docnums, max(1, min(num_strata, len(docnums)))):
+            num_sampled = max(min(2, len(stratum)), int(round(fraction * len(stratum))))
+            sampled = numpy.sort(random_state.choice(stratum, num_sampled, replace=False))
+            self.strata.append((len(stratum), sampled))
+        self.num_sampled = sum(len(s) for n, s in self.strata)
+
+    def summary(self):
+        """
+        Describes the sample, for including with estimated results.
+        """
+        return {'matches': self.num_matches, 'sampled': self.num_sampled, 'confidence': 0.95}
+
+    def estimate_counts(self, count_docs):
+        """
+        Estimates counts of documents by key over all the matches. The
+        count_docs function counts a set of document numbers by key, giving a
+        pair of arrays (integer keys, number of documents with each key); it
+        is called once for the sample of each stratum. Returns arrays of keys,
+        estimated counts and the margins of their confidence intervals, in
+        decreasing order of estimated count and then in key order.
+        """
+        all_keys, all_estimates, all_variances = [], [], []
+        for stratum_size, sampled in self.strata:
+            keys, counts = count_docs(sampled)
+            num_sampled = len(sampled)
+            proportions = counts.astype(numpy.float64) / num_sampled
+            correction = 1.0 - float(num_sampled) / stratum_size
+            all_keys.append(numpy.asarray(keys, dtype=numpy.int64))
+            all_estimates.append(stratum_size * proportions)
+            all_variances.append(stratum_size ** 2 * correction * proportions * (1.0 - proportions) / max(1, num_sampled - 1))
+
+        keys, inverse = numpy.unique(numpy.concatenate(all_keys), return_inverse=True)
+        estimates = numpy.bincount(inverse, weights=numpy.concatenate(all_estimates))
+        variances = numpy.bincount(inverse, weights=numpy.concatenate(all_variances))
+        order = numpy.argsort(-estimates, kind='mergesort')
+        estimates = numpy.rint(estimates[order]).astype(numpy.int64)
+        margins = numpy.ceil(confidence_z * numpy.sqrt(variances[order])).astype(numpy.int64)
+        return keys[order], estimates, margins
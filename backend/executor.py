@@ -0,0 +1,150 @@
+"""
+Running the CPU-bound part of queries in worker processes.
+"""
+
+import multiprocessing
+import os
+import time
+
+import whoosh.index
+import indexcolumns
+import queries
+import searchers
+
+from werkzeug.contrib.cache import NullCache
+
+# Use gevent sleeping if available, since the backend normally runs in gevent
+# greenlets under uWSGI.
+try:
+    import gevent
+    _sleep = gevent.sleep
+except ImportError:
+    _sleep = time.sleep
+
+# The querier of a worker process (see _init_worker())
+_worker_querier = None
+
+def _init_worker(index_dir_path, querier_settings, columns, make_cache):
+    """
+    Sets up a worker process with its own index searchers, and its own cache
+    made with make_cache (no cache if None). The worker starts with the
+    columns of the process it was forked from, which are shared with it until
+    either changes them, and builds its own for later generations of the
+    index. Its searchers only switch to a newer generation of the index when
+    a call is for it (see _run_in_worker()).
+    """
+    global _worker_querier
+    whoosh_index = whoosh.index.open_dir(index_dir_path)
+    _worker_querier = queries.Querier(whoosh_index, make_cache() if make_cache is not None else NullCache(),
+                                      columns=columns if columns is not None else indexcolumns.ColumnStore(),
+                                      searchers=searchers.SearcherPool(whoosh_index, check_interval=float('inf')),
+                                      **querier_settings)
+
+def _run_in_worker(method_name, query, index_identity, submit_time):
+    """
+    Runs a querier method in a worker process against the version of the
+    index with an identity, giving the seconds the call waited in the queue,
+    the seconds it ran for and its result. The result is None if the worker
+    cannot switch to that version, since it is no longer the latest.
+    """
+    start_time = time.time()
+    searcher_pool = _worker_querier.searchers
+    if searcher_pool.identity() != index_identity and searcher_pool.refresh(force=True) != index_identity:
+        return start_time - submit_time, 0.0, None
+    if hasattr(_worker_querier.cache, 'set_index_identity'):
+        _worker_querier.cache.set_index_identity(index_identity)
+    result = getattr(_worker_querier, method_name)(query)
+    return start_time - submit_time, time.time() - start_time, result
+
+class QueryExecutor:
+    """
+    Pool of worker processes computing view results, so that an expensive
+    query does not hold up the other greenlets of a backend process (which
+    keep answering from the cache and doing I/O while it runs). Each worker
+    has its own searchers and columns, since Whoosh searchers cannot be shared
+    between processes. Waiting for a result only sleeps the calling greenlet.
+
+    The workers are only started when first needed, in the process using the
+    executor, so an executor made before uWSGI forks its worker processes gets
+    workers of its own in each of them. Starting them after priming (see
+    Querier.prime()) lets them start with the primed columns.
+
+    Each worker makes its own cache with make_cache, if given, for views
+    caching results while they are computed (such as tsnecoordinates), since
+    cache clients cannot be shared between processes either. The results of
+    whole views are cached by the calling process.
+    """
+
+    def __init__(self, index_dir_path, num_processes, querier_settings, columns=None, make_cache=None, poll_interval=0.005):
+        self.index_dir_path = index_dir_path
+        self.num_processes = num_processes
+        self.querier_settings = querier_settings
+        self.columns = columns
+        self.make_cache = make_cache
+        self.poll_interval = poll_interval
+        self.pool = None
+        # Process the pool belongs to
+        self.pool_pid = None
+        # Number of calls submitted and not yet finished
+        self.queue_depth = 0
+        self.counters = {
+            'submitted': 0, 'failed': 0, 'mismatched': 0, 'max_queue_depth': 0,
+            'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'run_seconds': 0.0
+        }
+
+    def run(self, method_name, query, index_identity):
+        """
+        Calls a method of a worker's querier on a query, for example
+        Querier.compute_views(), against the version of the index with an
+        identity (see whooshutils.reader_index_identity()), and gets the
+        result. Exceptions in the worker are raised again here. Returns None
+        if the worker has a different version of the index, as when the
+        calling process has not yet switched to a newer one, in which case
+        the caller should compute the result itself.
+        """
+        if self.pool_pid != os.getpid():
+            self.pool = multiprocessing.Pool(self.num_processes, _init_worker,
+                                             (self.index_dir_path, self.querier_settings, self.columns, self.make_cache))
+            self.pool_pid = os.getpid()
+        self.queue_depth += 1
+        self.counters['submitted'] += 1
+        self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self.queue_depth)
+        try:
+            async_result = self.pool.apply_async(_run_in_worker, (method_name, query, index_identity, time.time()))
+            while not async_result.ready():
+                _sleep(self.poll_interval)
+            try:
+                wait_seconds, run_seconds, result = async_result.get()
+            except Exception:
+                self.counters['failed'] += 1
+                raise
+        finally:
+            self.queue_depth -= 1
+        self.counters['wait_seconds'] += wait_seconds
+        self.counters['max_wait_seconds'] = max(self.counters['max_wait_seconds'], wait_seconds)
+        self.counters['run_seconds'] += run_seconds
+        if result is None:
+            self.counters['mismatched'] += 1
+        return result
+
+    def stats(self):
+        """
+        Gets the counters, along with the current queue depth and the mean
+        seconds calls waited for a worker and ran for.
+        """
+        stats = dict(self.counters)
+        stats['queue_depth'] = self.queue_depth
+        completed = self.counters['submitted'] - self.counters['failed'] - self.queue_depth
+        stats['mean_wait_seconds'] = self.counters['wait_seconds'] / completed if completed > 0 else 0.0
+        stats['mean_run_seconds'] = self.counters['run_seconds'] / completed if completed > 0 else 0.0
+        return stats
+
+    def close(self):
+        """
+        Stops the worker processes, if they were started.
+        """
+        if self.pool_pid == os.getpid():
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.pool_pid = None
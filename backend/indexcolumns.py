@@ -0,0 +1,1028 @@
+"""
+Columnar copies of stored index fields, so that views can count over a set of
+matching documents without decoding stored fields for every hit.
+"""
+
+import collections
+import math
+import os.path
+import numpy
+import scipy.sparse
+import whooshutils
+import suggestions
+
+# Name of the reference point incidence matrix file written into the index
+# directory by build-index/cluster
+refpoint_matrix_file_name = "referencePoints.npz"
+# Name of the reference point levels file written into the index directory by
+# build-index/cluster
+refpoint_levels_file_name = "referencePointLevels.npz"
+# Name of the t-SNE coordinates file written into the index directory by
+# build-index/tsne
+tsne_coordinates_file_name = "tsneCoordinates.npy"
+
+def unique_counts(values):
+    """
+    Gets the distinct values of an array, sorted, and the number of times each
+    occurs (as numpy.unique() with return_counts, which needs numpy 1.9).
+    """
+    keys, inverse = numpy.unique(values, return_inverse=True)
+    if len(keys) == 0:
+        return keys, numpy.zeros(0, dtype=numpy.int64)
+    return keys, numpy.bincount(inverse)
+
+def count_ids(ids, length):
+    """
+    Counts the occurrences of each ID in an array of IDs less than a length,
+    as numpy.bincount() with minlength, which before numpy 1.14 rejects a
+    minlength of 0.
+    """
+    if length == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.bincount(ids, minlength=length)
+
+class KeywordColumn:
+    """
+    Document to value mapping for a single (possibly multiple-valued) field.
+    Each distinct value is kept once in a value dictionary and documents refer
+    to values by integer ID. The per-document value IDs are stored in
+    compressed sparse row form: the IDs for document number d are
+    value_ids[offsets[d]:offsets[d+1]], and contain no duplicates. The present
+    mask records which documents have the field stored at all (possibly with
+    no values).
+    """
+
+    def __init__(self, values, value_index, offsets, value_ids, present):
+        self.values = values
+        self.value_index = value_index
+        self.offsets = offsets
+        self.value_ids = value_ids
+        self.present = present
+        # Document number for each entry, so that a document mask can be
+        # applied to the entries directly.
+        self.entry_docnums = numpy.repeat(numpy.arange(len(offsets) - 1, dtype=numpy.int32), numpy.diff(offsets))
+        # Document numbers for each value ID (built on first use, see
+        # inverted())
+        self.value_offsets = None
+        self.docnums_by_value = None
+
+    def doc_value_ids(self, docnum):
+        """
+        Gets the value IDs for a single document.
+        """
+        return self.value_ids[self.offsets[docnum]:self.offsets[docnum + 1]]
+
+    def doc_values(self, docnum):
+        """
+        Gets the values for a single document.
+        """
+        return [self.values[i] for i in self.doc_value_ids(docnum)]
+
+    def inverted(self):
+        """
+        Gets the document numbers for each value ID in compressed sparse form,
+        as a pair (value_offsets, docnums): the document numbers having value
+        ID i are docnums[value_offsets[i]:value_offsets[i+1]], in increasing
+        order.
+        """
+        if self.value_offsets is None:
+            self.value_offsets = numpy.zeros(len(self.values) + 1, dtype=numpy.int64)
+            numpy.cumsum(count_ids(self.value_ids, len(self.values)), out=self.value_offsets[1:])
+            self.docnums_by_value = self.entry_docnums[numpy.argsort(self.value_ids, kind='mergesort')]
+        return self.value_offsets, self.docnums_by_value
+
+    def value_docnums(self, value_id):
+        """
+        Gets the increasing document numbers of the documents having a value,
+        by value ID.
+        """
+        value_offsets, docnums = self.inverted()
+        return docnums[value_offsets[value_id]:value_offsets[value_id + 1]]
+
+    def mask_for_value(self, value):
+        """
+        Makes a boolean mask over document numbers for the documents having a
+        given value.
+        """
+        mask = numpy.zeros(len(self.present), dtype=bool)
+        value_id = self.value_index.get(value)
+        if value_id is not None:
+            mask[self.value_docnums(value_id)] = True
+        return mask
+
+    def count(self, mask):
+        """
+        Counts the documents having each value, restricted to the documents
+        set in a boolean mask over document numbers. Returns an array indexed
+        by value ID.
+        """
+        ids = self.value_ids[mask[self.entry_docnums]]
+        return count_ids(ids, len(self.values))
+
+    def count_range(self, mask, start):
+        """
+        Counts as for count(), but only over the documents numbered from start
+        on, with a boolean mask over just those documents, so that partitions
+        of the documents can be counted separately (see partitions.py) and
+        their counts added up.
+        """
+        first, last = self.offsets[start], self.offsets[start + len(mask)]
+        ids = self.value_ids[first:last][mask[self.entry_docnums[first:last] - start]]
+        return count_ids(ids, len(self.values))
+
+    def count_docs(self, docnums):
+        """
+        Counts the documents having each value among a few documents given by
+        number, looking only at their entries. Returns a pair of arrays: the
+        value IDs with non-zero counts, and their counts.
+        """
+        starts, ends = self.offsets[docnums], self.offsets[numpy.asarray(docnums) + 1]
+        lengths = ends - starts
+        entries = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum())
+        return unique_counts(self.value_ids[entries])
+
+    def sorted_counts(self, mask):
+        """
+        Counts as for count(), but as a list of (value, count) pairs for
+        values with non-zero counts, sorted by decreasing count.
+        """
+        return self.top_counts(mask)[0]
+
+    def top_counts(self, mask, k=None, counts=None):
+        """
+        Gets the first k pairs of sorted_counts() (all of them if k is None),
+        along with the number of values with non-zero counts. Only the values
+        which can be in the first k are sorted, so for fields with many
+        distinct values the cost of the result depends on k rather than on
+        the number of values. The counts from count() can be given if already
+        counted.
+        """
+        if counts is None:
+            counts = self.count(mask)
+        nonzero = numpy.flatnonzero(counts)
+        num_values = len(nonzero)
+        if k is not None and num_values > k:
+            if k <= 0:
+                return [], num_values
+            # Keep everything at least as frequent as the k'th value, so that
+            # ties are still broken by value ID
+            nonzero_counts = counts[nonzero]
+            threshold = -numpy.partition(-nonzero_counts, k - 1)[k - 1]
+            nonzero = nonzero[nonzero_counts >= threshold]
+        order = nonzero[numpy.argsort(-counts[nonzero], kind='mergesort')][:k]
+        return [(self.values[i], int(counts[i])) for i in order], num_values
+
+    def value_counts(self, mask, values):
+        """
+        Counts the documents set in a mask having each of the given values,
+        without counting any other values. Returns (value, count) pairs for
+        the values with non-zero counts, in the given order.
+        """
+        pairs = []
+        for value in values:
+            value_id = self.value_index.get(value)
+            if value_id is not None:
+                count = int(numpy.count_nonzero(mask[self.value_docnums(value_id)]))
+                if count > 0:
+                    pairs.append((value, count))
+        return pairs
+
+def build_keyword_columns(reader, field_names):
+    """
+    Builds keyword columns for several fields in a single pass over the stored
+    documents of an index reader. Fields which are not stored in a document
+    have no values for that document.
+    """
+    num_docs = reader.doc_count_all()
+    value_index = dict((f, {}) for f in field_names)
+    values = dict((f, []) for f in field_names)
+    counts = dict((f, numpy.zeros(num_docs, dtype=numpy.int64)) for f in field_names)
+    ids = dict((f, []) for f in field_names)
+    present = dict((f, numpy.zeros(num_docs, dtype=bool)) for f in field_names)
+
+    for docnum, stored in reader.iter_docs():
+        for field_name in field_names:
+            if field_name in stored:
+                field_index = value_index[field_name]
+                field_values = values[field_name]
+                doc_ids = set()
+                for value in whooshutils.split_keywords(stored[field_name]):
+                    value_id = field_index.get(value)
+                    if value_id is None:
+                        value_id = field_index[value] = len(field_values)
+                        field_values.append(value)
+                    doc_ids.add(value_id)
+                counts[field_name][docnum] = len(doc_ids)
+                present[field_name][docnum] = True
+                ids[field_name].extend(sorted(doc_ids))
+
+    columns = {}
+    for field_name in field_names:
+        offsets = numpy.zeros(num_docs + 1, dtype=numpy.int64)
+        numpy.cumsum(counts[field_name], out=offsets[1:])
+        columns[field_name] = KeywordColumn(values[field_name], value_index[field_name], offsets, numpy.array(ids[field_name], dtype=numpy.int32), present[field_name])
+    return columns
+
+class EntityYearCube:
+    """
+    Sparse (entity, year, cluster value) incidence for an entity field and a
+    cluster field: for each value of the entity field, an entry for every
+    document having that value and every cluster field value of the document,
+    giving the document number, its year and the cluster value ID. Entries are
+    grouped by entity value ID in the same compressed sparse form as keyword
+    columns. Documents with the cluster field stored but without values get an
+    entry with cluster value ID -1, so that their year still shows up.
+    """
+
+    def __init__(self, entity_column, cluster_column, years):
+        self.entity_column = entity_column
+        self.cluster_column = cluster_column
+
+        entity_entry_offsets, entity_docnums = entity_column.inverted()
+
+        num_cluster_values = numpy.diff(cluster_column.offsets)
+        per_doc = numpy.where(cluster_column.present, numpy.maximum(num_cluster_values, 1), 0)
+        per_entity_entry = per_doc[entity_docnums]
+        entry_offsets = numpy.zeros(len(entity_docnums) + 1, dtype=numpy.int64)
+        numpy.cumsum(per_entity_entry, out=entry_offsets[1:])
+        self.offsets = entry_offsets[entity_entry_offsets]
+
+        self.docnums = numpy.repeat(entity_docnums, per_entity_entry)
+        self.years = years[self.docnums]
+        # Position of each entry within the values of its document
+        positions = numpy.arange(entry_offsets[-1]) - numpy.repeat(entry_offsets[:-1], per_entity_entry)
+        has_value = positions < num_cluster_values[self.docnums]
+        self.cluster_ids = numpy.full(len(self.docnums), -1, dtype=numpy.int32)
+        self.cluster_ids[has_value] = cluster_column.value_ids[cluster_column.offsets[self.docnums[has_value]] + positions[has_value]]
+
+    def timeline_keys(self, value_id, mask, start=0):
+        """
+        Gets the distinct (year, cluster value) pairs of the documents in a
+        mask having an entity value, by value ID, encoded as integer keys. The
+        mask may cover only the documents numbered from start on, so that
+        partitions of the documents can be done separately (see
+        partitions.py) and the union of their keys taken.
+        """
+        first, last = self.offsets[value_id], self.offsets[value_id + 1]
+        if start > 0 or len(mask) < len(self.entity_column.present):
+            # Entries are in increasing document number order for each value
+            docnums = self.docnums[first:last]
+            first, last = first + numpy.searchsorted(docnums, [start, start + len(mask)])
+        keep = mask[self.docnums[first:last] - start]
+        stride = len(self.cluster_column.values) + 1
+        return numpy.unique(self.years[first:last][keep] * stride + self.cluster_ids[first:last][keep] + 1)
+
+    def timeline(self, entity_value, mask, keys=None):
+        """
+        Gets the cluster values of the documents in a mask having an entity
+        value, as a dictionary of lists of cluster values keyed by year. The
+        keys from timeline_keys() can be given if already found.
+        """
+        value_id = self.entity_column.value_index.get(entity_value)
+        if value_id is None:
+            return {}
+        if keys is None:
+            keys = self.timeline_keys(value_id, mask)
+        stride = len(self.cluster_column.values) + 1
+        timeline = {}
+        cluster_values = self.cluster_column.values
+        for year, cluster_id in zip((keys // stride).tolist(), (keys % stride - 1).tolist()):
+            year_values = timeline.setdefault(year, [])
+            if cluster_id >= 0:
+                year_values.append(cluster_values[cluster_id])
+        return timeline
+
+class YearHistogram:
+    """
+    Document counts by year. Each document's year is kept as an index into the
+    increasing distinct years (-1 for documents without a year), and the
+    cumulative counts of all documents over the distinct years are
+    precomputed, so that the count over all documents for any span of years is
+    the difference of two prefix sums.
+    """
+
+    # Bucket sizes to choose from for a maximum number of buckets, repeating
+    # at each power of ten
+    nice_bucket_sizes = [1, 2, 5]
+
+    def __init__(self, years, doc_year_indexes):
+        self.years = years
+        self.doc_year_indexes = doc_year_indexes
+        self.has_year = doc_year_indexes >= 0
+        self.cumulative = self._cumulative(count_ids(doc_year_indexes[self.has_year], len(years)))
+
+    def _cumulative(self, counts):
+        cumulative = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=cumulative[1:])
+        return cumulative
+
+    def bucket_size_for(self, max_buckets):
+        """
+        Gets the smallest bucket size of 1, 2 or 5 times a power of ten giving
+        at most a number of buckets over the span of all years.
+        """
+        if len(self.years) == 0:
+            return 1
+        magnitude = 1
+        while True:
+            for size in self.nice_bucket_sizes:
+                bucket_size = size * magnitude
+                if self.years[-1] // bucket_size - self.years[0] // bucket_size + 1 <= max_buckets:
+                    return bucket_size
+            magnitude *= 10
+
+    def counts(self, mask=None, bucket_size=1):
+        """
+        Counts the documents in a mask (all documents if not given) in buckets
+        of years starting at multiples of the bucket size. Returns a list of
+        (first year of bucket, count) pairs for non-zero counts, sorted by
+        decreasing count and then by year.
+        """
+        if mask is None:
+            cumulative = self.cumulative
+        else:
+            cumulative = self._cumulative(count_ids(self.doc_year_indexes[mask & self.has_year], len(self.years)))
+        if len(self.years) == 0:
+            return []
+        if bucket_size == 1:
+            starts = self.years
+            bounds = numpy.arange(len(self.years) + 1)
+        else:
+            starts = numpy.arange(self.years[0] // bucket_size, self.years[-1] // bucket_size + 1) * bucket_size
+            bounds = numpy.searchsorted(self.years, numpy.append(starts, starts[-1] + bucket_size))
+        counts = cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+        nonzero = numpy.flatnonzero(counts)
+        order = nonzero[numpy.argsort(-counts[nonzero], kind='mergesort')]
+        return [(int(starts[i]), int(counts[i])) for i in order]
+
+class IncidenceMatrix:
+    """
+    Sparse document by reference point incidence matrix, with rows indexed by
+    document number and the reference point for each column.
+    """
+
+    def __init__(self, matrix, refpoints):
+        self.matrix = matrix
+        self.refpoints = refpoints
+        # Longitude and latitude of each reference point (parsed on first use)
+        self.lonlat = None
+
+    def refpoints_within(self, bounds):
+        """
+        Makes a boolean mask over the reference points for those within bounds
+        given as a dictionary of west, south, east and north in degrees. The
+        bounds wrap around the antimeridian if west is greater than east.
+        """
+        if self.lonlat is None:
+            self.lonlat = numpy.array([[float(x) for x in r.split(',')] for r in self.refpoints], dtype=numpy.float64).reshape(-1, 2)
+        lons, lats = self.lonlat[:, 0], self.lonlat[:, 1]
+        west, east = bounds['west'], bounds['east']
+        if west <= east:
+            within_lons = (lons >= west) & (lons <= east)
+        else:
+            within_lons = (lons >= west) | (lons <= east)
+        return within_lons & (lats >= bounds['south']) & (lats <= bounds['north'])
+
+    def count_range(self, mask, start=0):
+        """
+        Counts the documents in a mask having each reference point, as an
+        array indexed by reference point. The mask may cover only the
+        documents numbered from start on, so that partitions of the documents
+        can be counted separately (see partitions.py) and their counts added
+        up.
+        """
+        return numpy.asarray(self.matrix[start + numpy.flatnonzero(mask)].sum(axis=0)).ravel()
+
+    def sorted_counts(self, mask, within=None, counts=None):
+        """
+        Counts the documents in a mask having each reference point, optionally
+        only for the reference points set in a mask over them. Returns a list
+        of (refpoint, count) pairs for non-zero counts, sorted by decreasing
+        count. The counts from count_range() can be given if already counted.
+        """
+        if counts is None:
+            counts = self.count_range(mask)
+        else:
+            counts = counts.copy()
+        if within is not None:
+            counts[~within] = 0
+        nonzero = numpy.flatnonzero(counts)
+        order = nonzero[numpy.argsort(-counts[nonzero], kind='mergesort')]
+        return [(self.refpoints[i], int(counts[i])) for i in order]
+
+    def link_matrix(self, mask, start=0):
+        """
+        Counts the documents in a mask having each pair of distinct reference
+        points, as the sparse upper triangle of (A^T A) for the rows A selected
+        by the mask. The mask may cover only the documents numbered from start
+        on, so that partitions of the documents can be counted separately (see
+        partitions.py) and their link matrices added up.
+        """
+        selected = self.matrix[start + numpy.flatnonzero(mask)]
+        return scipy.sparse.triu(selected.T.dot(selected), k=1)
+
+    def link_counts(self, mask, within=None, links=None):
+        """
+        Counts the documents in a mask having each pair of distinct reference
+        points, as the upper triangle of (A^T A) for the rows A selected by
+        the mask. Returns a list of ((refpoint1, refpoint2), count) pairs for
+        non-zero counts, with each pair in lexicographic order. If a mask over
+        the reference points is given, only links with at least one end in it
+        are counted. The link matrix from link_matrix() can be given if
+        already counted.
+        """
+        if links is None:
+            links = self.link_matrix(mask)
+        # In row and then column order, so that the order of the links (and so
+        # their pages) does not depend on how they were counted
+        links = links.tocsr()
+        links.sort_indices()
+        links = links.tocoo()
+        rows, cols, data = links.row, links.col, links.data
+        if within is not None:
+            keep = within[rows] | within[cols]
+            rows, cols, data = rows[keep], cols[keep], data[keep]
+        refpoints = self.refpoints
+        result = []
+        for i, j, count in zip(rows.tolist(), cols.tolist(), data.tolist()):
+            refpoint1, refpoint2 = refpoints[i], refpoints[j]
+            result.append(((refpoint1, refpoint2) if refpoint1 < refpoint2 else (refpoint2, refpoint1), count))
+        return result
+
+    def count_docs(self, docnums):
+        """
+        Counts the documents having each reference point among documents given
+        by number. Returns a pair of arrays: the reference point indexes with
+        non-zero counts, and their counts.
+        """
+        counts = numpy.asarray(self.matrix[docnums].sum(axis=0)).ravel()
+        nonzero = numpy.flatnonzero(counts)
+        return nonzero, counts[nonzero]
+
+    def link_count_docs(self, docnums):
+        """
+        Counts the documents having each pair of distinct reference points
+        among documents given by number. Returns a pair of arrays: keys for
+        the pairs with non-zero counts (see link_refpoints()), and their
+        counts.
+        """
+        selected = self.matrix[docnums]
+        links = scipy.sparse.triu(selected.T.dot(selected), k=1).tocoo()
+        return links.row.astype(numpy.int64) * len(self.refpoints) + links.col, links.data
+
+    def link_refpoints(self, key):
+        """
+        Gets the pair of reference points, in lexicographic order, for a key
+        from link_count_docs().
+        """
+        i, j = divmod(int(key), len(self.refpoints))
+        refpoint1, refpoint2 = self.refpoints[i], self.refpoints[j]
+        return (refpoint1, refpoint2) if refpoint1 < refpoint2 else (refpoint2, refpoint1)
+
+def load_incidence_matrix(path, id_docnums, num_docs):
+    """
+    Loads the incidence matrix written by build-index/cluster, where rows are
+    keyed by event ID, and maps the rows to document numbers. Events not in
+    the index are dropped.
+    """
+    data = numpy.load(path)
+    ids, indptr, indices = data['ids'], data['indptr'], data['indices']
+    known = (ids >= 0) & (ids < len(id_docnums))
+    row_docnums = numpy.full(len(ids), -1, dtype=numpy.int64)
+    row_docnums[known] = id_docnums[ids[known]]
+    entry_docnums = numpy.repeat(row_docnums, numpy.diff(indptr))
+    keep = entry_docnums >= 0
+    refpoints = [unicode(r) for r in data['refpoints']]
+    matrix = scipy.sparse.csr_matrix((numpy.ones(keep.sum(), dtype=numpy.int32), (entry_docnums[keep], indices[keep])), shape=(num_docs, len(refpoints)))
+    return IncidenceMatrix(matrix, refpoints)
+
+class TsneCoordinates:
+    """
+    The t-SNE coordinates of events, as a float32 array with an (x, y) row for
+    each event ID (NaN for events without coordinates), and the event ID for
+    each document number (-1 for none). Rows are keyed by event ID rather than
+    document number so that the array written at build time stays valid for
+    every generation of the index, and can be memory-mapped.
+    """
+
+    def __init__(self, coordinates, docnum_ids):
+        self.coordinates = coordinates
+        self.docnum_ids = docnum_ids
+        self.bounds = None
+        self.point_grid = None
+        self.point_grid_cells = None
+
+    def points(self, mask):
+        """
+        Gets the event IDs and coordinates of the documents in a mask having
+        coordinates, as arrays (ids, xs, ys).
+        """
+        ids = self.docnum_ids[mask]
+        ids = ids[(ids >= 0) & (ids < len(self.coordinates))]
+        coordinates = numpy.asarray(self.coordinates[ids])
+        known = ~numpy.isnan(coordinates[:, 0])
+        return ids[known], coordinates[known, 0], coordinates[known, 1]
+
+    def grid(self, num_cells):
+        """
+        Gets a grid index over the coordinates of all documents, with about
+        num_cells cells along the longer side of the layout.
+        """
+        if self.point_grid is None or self.point_grid_cells != num_cells:
+            ids, xs, ys = self.points(self.docnum_ids >= 0)
+            min_x, min_y, max_x, max_y = self.extent()
+            cell_size = max(max_x - min_x, max_y - min_y) / num_cells or 1.0
+            id_docnums = numpy.full(len(self.coordinates), -1, dtype=numpy.int64)
+            id_docnums[self.docnum_ids[self.docnum_ids >= 0]] = numpy.flatnonzero(self.docnum_ids >= 0)
+            self.point_grid = PointGrid(xs.astype(numpy.float64), ys.astype(numpy.float64), id_docnums[ids], len(self.docnum_ids), min_x, min_y, max_x, max_y, cell_size)
+            self.point_grid_cells = num_cells
+        return self.point_grid
+
+    def extent(self):
+        """
+        Gets the bounds (min_x, min_y, max_x, max_y) of all coordinates, or
+        all zeros if there are none.
+        """
+        if self.bounds is None:
+            ids, xs, ys = self.points(numpy.ones(len(self.docnum_ids), dtype=bool))
+            if len(ids) > 0:
+                self.bounds = (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))
+            else:
+                self.bounds = (0.0, 0.0, 0.0, 0.0)
+        return self.bounds
+
+def build_tsne_coordinates(column, id_docnums):
+    """
+    Builds the t-SNE coordinates array keyed by event ID from the keyword
+    column of the stored coordinates, for indexes without a coordinates file.
+    A document with several coordinates gets its first.
+    """
+    value_coordinates = numpy.array([[float(c) for c in v.split(',')] for v in column.values], dtype=numpy.float32).reshape(-1, 2)
+    coordinates = numpy.full((len(id_docnums), 2), numpy.nan, dtype=numpy.float32)
+    ids = numpy.flatnonzero(id_docnums >= 0)
+    docnums = id_docnums[ids]
+    has_value = numpy.diff(column.offsets)[docnums] > 0
+    coordinates[ids[has_value]] = value_coordinates[column.value_ids[column.offsets[docnums[has_value]]]]
+    return coordinates
+
+class RefpointLevels:
+    """
+    Hierarchy of coarser reference point levels written by build-index/cluster,
+    from the coarsest. Level i has the reference point values
+    level_refpoints[i], and parents[i] gives the index of the level i
+    reference point for each of the (finest) reference points refpoints. Level
+    num_levels is the reference points themselves.
+    """
+
+    def __init__(self, refpoints, level_refpoints, parents):
+        self.refpoints = refpoints
+        self.refpoint_index = dict((r, i) for i, r in enumerate(refpoints))
+        self.level_refpoints = level_refpoints
+        self.parents = parents
+        self.num_levels = len(level_refpoints)
+
+    def expand(self, level_refpoints, level):
+        """
+        Gets the reference points under the given reference points of a level.
+        Values not in the level are kept as they are.
+        """
+        if level >= self.num_levels or level < 0:
+            return list(level_refpoints)
+        level_index = dict((r, i) for i, r in enumerate(self.level_refpoints[level]))
+        wanted = set(level_index[r] for r in level_refpoints if r in level_index)
+        expanded = [r for r in level_refpoints if r not in level_index]
+        expanded.extend(self.refpoints[i] for i in numpy.flatnonzero(numpy.in1d(self.parents[level], list(wanted))))
+        return expanded
+
+    def coarsen(self, incidence, level):
+        """
+        Makes the incidence matrix for a level from the one for the reference
+        points, with a document having a level reference point if it has any of
+        the reference points under it. Reference points not in the hierarchy
+        are dropped.
+        """
+        finest = numpy.array([self.refpoint_index.get(r, -1) for r in incidence.refpoints], dtype=numpy.int64)
+        known = numpy.flatnonzero(finest >= 0)
+        level_refpoints = self.level_refpoints[level]
+        projection = scipy.sparse.csr_matrix((numpy.ones(len(known), dtype=numpy.int32), (known, self.parents[level][finest[known]])), shape=(len(incidence.refpoints), len(level_refpoints)))
+        matrix = incidence.matrix.dot(projection).tocsr()
+        matrix.data[:] = 1
+        return IncidenceMatrix(matrix, level_refpoints)
+
+def load_refpoint_levels(path):
+    """
+    Loads the reference point levels written by build-index/cluster.
+    """
+    data = numpy.load(path)
+    num_levels = int(data['num_levels'])
+    level_refpoints = [[unicode(r) for r in data['refpoints_%i' % (i)]] for i in range(num_levels)]
+    parents = [data['parents_%i' % (i)] for i in range(num_levels)]
+    return RefpointLevels([unicode(r) for r in data['refpoints']], level_refpoints, parents)
+
+class PointGrid:
+    """
+    Grid index over points of documents in a rectangular extent, with square
+    cells of a given size. Points are kept sorted by cell in row-major order
+    (rows of y, each of cells of x), with the points of cell c at
+    cell_offsets[c]:cell_offsets[c+1], so the points of a run of cells in a
+    row are contiguous. A region is then looked up one row of cells at a time,
+    and only the points in cells on its edge need testing. Points outside the
+    extent go in the nearest cell.
+    """
+
+    def __init__(self, xs, ys, docnums, num_docs, min_x, min_y, max_x, max_y, cell_size):
+        self.num_docs = num_docs
+        self.min_x, self.min_y = min_x, min_y
+        self.cell_size = cell_size
+        self.num_columns = max(1, int(math.ceil((max_x - min_x) / cell_size)))
+        self.num_rows = max(1, int(math.ceil((max_y - min_y) / cell_size)))
+        cells = self.rows(ys) * self.num_columns + self.columns(xs)
+        order = numpy.argsort(cells, kind='mergesort')
+        self.xs, self.ys, self.docnums = xs[order], ys[order], docnums[order]
+        self.cell_offsets = numpy.zeros(self.num_rows * self.num_columns + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(cells, minlength=self.num_rows * self.num_columns), out=self.cell_offsets[1:])
+
+    def columns(self, xs):
+        return numpy.clip(numpy.floor((numpy.asarray(xs) - self.min_x) / self.cell_size).astype(numpy.int64), 0, self.num_columns - 1)
+
+    def rows(self, ys):
+        return numpy.clip(numpy.floor((numpy.asarray(ys) - self.min_y) / self.cell_size).astype(numpy.int64), 0, self.num_rows - 1)
+
+    def _points_in_box(self, x0, y0, x1, y1):
+        """
+        Gets the positions of the points in the cells covering a box, as a list
+        of (start, end, needs_test) runs where needs_test tells if the points
+        of the run may be outside the box.
+        """
+        first_column, last_column = self.columns([x0, x1]).tolist()
+        first_row, last_row = self.rows([y0, y1]).tolist()
+        runs = []
+        for row in range(first_row, last_row + 1):
+            row_start = row * self.num_columns
+            if row == first_row or row == last_row or last_column - first_column < 2:
+                runs.append((self.cell_offsets[row_start + first_column], self.cell_offsets[row_start + last_column + 1], True))
+            else:
+                runs.append((self.cell_offsets[row_start + first_column], self.cell_offsets[row_start + first_column + 1], True))
+                runs.append((self.cell_offsets[row_start + first_column + 1], self.cell_offsets[row_start + last_column], False))
+                runs.append((self.cell_offsets[row_start + last_column], self.cell_offsets[row_start + last_column + 1], True))
+        return runs
+
+    def box_size_estimate(self, x0, y0, x1, y1):
+        """
+        Gets an upper bound on the number of documents with a point within a
+        box without testing any points: the number of points in the cells
+        covering it.
+        """
+        return int(sum(end - start for start, end, needs_test in self._points_in_box(x0, y0, x1, y1)))
+
+    def polygon_size_estimate(self, polygon):
+        """
+        Gets an upper bound on the number of documents with a point within a
+        polygon, given as a list of (x, y) vertices, from its bounding box.
+        """
+        vertices = numpy.array(polygon, dtype=numpy.float64).reshape(-1, 2)
+        x0, y0 = vertices.min(axis=0)
+        x1, y1 = vertices.max(axis=0)
+        return self.box_size_estimate(x0, y0, x1, y1)
+
+    def box_mask(self, x0, y0, x1, y1):
+        """
+        Makes a boolean mask over document numbers for the documents with a
+        point within a box.
+        """
+        mask = numpy.zeros(self.num_docs, dtype=bool)
+        for start, end, needs_test in self._points_in_box(x0, y0, x1, y1):
+            docnums = self.docnums[start:end]
+            if needs_test:
+                xs, ys = self.xs[start:end], self.ys[start:end]
+                docnums = docnums[(xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)]
+            mask[docnums] = True
+        return mask
+
+    def polygon_mask(self, polygon):
+        """
+        Makes a boolean mask over document numbers for the documents with a
+        point within a polygon, given as a list of (x, y) vertices.
+        """
+        vertices = numpy.array(polygon, dtype=numpy.float64).reshape(-1, 2)
+        x0, y0 = vertices.min(axis=0)
+        x1, y1 = vertices.max(axis=0)
+        runs = self._points_in_box(x0, y0, x1, y1)
+        positions = numpy.concatenate([numpy.arange(start, end) for start, end, needs_test in runs] or [numpy.zeros(0, dtype=numpy.int64)])
+        xs, ys = self.xs[positions], self.ys[positions]
+        # Even-odd rule: count the polygon edges crossed by a ray going in the
+        # increasing x direction from each point
+        inside = numpy.zeros(len(positions), dtype=bool)
+        for (vx1, vy1), (vx2, vy2) in zip(vertices, numpy.roll(vertices, -1, axis=0)):
+            crosses = (vy1 > ys) != (vy2 > ys)
+            if vy1 != vy2:
+                crosses &= xs < vx1 + (ys - vy1) * (vx2 - vx1) / (vy2 - vy1)
+            inside ^= crosses
+        mask = numpy.zeros(self.num_docs, dtype=bool)
+        mask[self.docnums[positions[inside]]] = True
+        return mask
+
+def build_geo_grid(column, num_docs, cell_degrees):
+    """
+    Builds the grid index over longitude and latitude from the keyword column
+    of event points, where each value is a longitude and latitude separated by
+    a comma.
+    """
+    value_points = numpy.array([[float(x) for x in v.split(',')] for v in column.values], dtype=numpy.float64).reshape(-1, 2)
+    points = value_points[column.value_ids]
+    return PointGrid(points[:, 0], points[:, 1], column.entry_docnums.astype(numpy.int64), num_docs, -180.0, -90.0, 180.0, 90.0, cell_degrees)
+
+class MaskCache:
+    """
+    Least recently used cache of document masks. Masks are kept packed as bits
+    to keep the memory per entry small.
+    """
+
+    def __init__(self, num_docs, max_size):
+        self.num_docs = num_docs
+        self.max_size = max_size
+        self.packed_masks = collections.OrderedDict()
+
+    def get(self, key):
+        packed = self.packed_masks.pop(key, None)
+        if packed is None:
+            return None
+        self.packed_masks[key] = packed
+        return numpy.unpackbits(packed)[:self.num_docs].view(bool)
+
+    def set(self, key, mask):
+        self.packed_masks.pop(key, None)
+        self.packed_masks[key] = numpy.packbits(mask)
+        while len(self.packed_masks) > self.max_size:
+            self.packed_masks.popitem(last=False)
+
+class IndexColumns:
+    """
+    All columns for one generation of an index. Columns are built on first
+    use and then kept for the life of the generation. Document numbers are
+    only meaningful for readers of the same generation.
+    """
+
+    def __init__(self, generation, num_docs, identity=None):
+        self.generation = generation
+        # Identity of the index version (see
+        # whooshutils.reader_index_identity()), which unlike the generation
+        # number changes when the index is rebuilt
+        self.identity = identity
+        self.num_docs = num_docs
+        self.keyword_columns = {}
+        self.numeric_columns = {}
+        self.live_mask = None
+        self.constraint_masks = None
+        self.id_docnums = None
+        self.refpoint_matrix = None
+        self.refpoint_levels = None
+        self.level_refpoint_matrices = {}
+        self.year_order = None
+        self.year_histogram = None
+        self.entity_year_cubes = {}
+        self.tsne_coordinates = None
+        self.geo_grids = {}
+        self.lexicons = {}
+
+    def mask(self, docnums):
+        """
+        Makes a boolean mask over document numbers from an iterable of
+        document numbers.
+        """
+        mask = numpy.zeros(self.num_docs, dtype=bool)
+        mask[numpy.fromiter(docnums, dtype=numpy.int64)] = True
+        return mask
+
+    def get_live_mask(self, reader):
+        """
+        Gets the mask of all documents which are not deleted.
+        """
+        if self.live_mask is None:
+            self.live_mask = self.mask(reader.all_doc_ids())
+        return self.live_mask
+
+    def get_id_docnums(self, reader):
+        """
+        Gets an array mapping event IDs to document numbers, with -1 for IDs
+        not in the index. This is read from the postings of the ID field
+        rather than from stored fields.
+        """
+        if self.id_docnums is None:
+            field = reader.schema['id']
+            ids, docnums = [], []
+            for term in field.sortable_terms(reader, 'id'):
+                event_id = field.from_bytes(term)
+                for docnum in reader.postings('id', term).all_ids():
+                    ids.append(event_id)
+                    docnums.append(docnum)
+            self.id_docnums = numpy.full(max(ids) + 1 if len(ids) > 0 else 0, -1, dtype=numpy.int64)
+            self.id_docnums[ids] = docnums
+        return self.id_docnums
+
+    def get_refpoint_matrix(self, reader, index_dir_path):
+        """
+        Gets the document by reference point incidence matrix. Uses the matrix
+        written by the clustering step into the index directory if there is
+        one, and otherwise builds it from the reference points column.
+        """
+        if self.refpoint_matrix is None:
+            path = os.path.join(index_dir_path, refpoint_matrix_file_name) if index_dir_path is not None else None
+            if path is not None and os.path.exists(path):
+                self.refpoint_matrix = load_incidence_matrix(path, self.get_id_docnums(reader), self.num_docs)
+            else:
+                column = self.get_keyword_columns(reader, ['referencePoints'])['referencePoints']
+                matrix = scipy.sparse.csr_matrix((numpy.ones(len(column.value_ids), dtype=numpy.int32), column.value_ids, column.offsets), shape=(self.num_docs, len(column.values)))
+                self.refpoint_matrix = IncidenceMatrix(matrix, column.values)
+        return self.refpoint_matrix
+
+    def get_tsne_coordinates(self, reader, index_dir_path):
+        """
+        Gets the t-SNE coordinates of all events. Memory-maps the coordinates
+        file written by build-index/tsne into the index directory if there is
+        one, and otherwise builds the coordinates from the stored fields.
+        """
+        if self.tsne_coordinates is None:
+            id_docnums = self.get_id_docnums(reader)
+            docnum_ids = numpy.full(self.num_docs, -1, dtype=numpy.int64)
+            ids = numpy.flatnonzero(id_docnums >= 0)
+            docnum_ids[id_docnums[ids]] = ids
+            path = os.path.join(index_dir_path, tsne_coordinates_file_name) if index_dir_path is not None else None
+            if path is not None and os.path.exists(path):
+                coordinates = numpy.load(path, mmap_mode='r')
+            else:
+                column = self.get_keyword_columns(reader, ['2DtSNECoordinates'])['2DtSNECoordinates']
+                coordinates = build_tsne_coordinates(column, id_docnums)
+            self.tsne_coordinates = TsneCoordinates(coordinates, docnum_ids)
+        return self.tsne_coordinates
+
+    def get_refpoint_levels(self, index_dir_path):
+        """
+        Gets the reference point levels written by the clustering step into the
+        index directory, or no levels if there is no levels file.
+        """
+        if self.refpoint_levels is None:
+            path = os.path.join(index_dir_path, refpoint_levels_file_name) if index_dir_path is not None else None
+            if path is not None and os.path.exists(path):
+                self.refpoint_levels = load_refpoint_levels(path)
+            else:
+                self.refpoint_levels = RefpointLevels([], [], [])
+        return self.refpoint_levels
+
+    def get_level_refpoint_matrix(self, reader, index_dir_path, level):
+        """
+        Gets the document by reference point incidence matrix for a level of
+        the reference point hierarchy.
+        """
+        levels = self.get_refpoint_levels(index_dir_path)
+        if level >= levels.num_levels:
+            return self.get_refpoint_matrix(reader, index_dir_path)
+        if level not in self.level_refpoint_matrices:
+            self.level_refpoint_matrices[level] = levels.coarsen(self.get_refpoint_matrix(reader, index_dir_path), level)
+        return self.level_refpoint_matrices[level]
+
+    def get_geo_grid(self, reader, cell_degrees):
+        """
+        Gets the grid index over the points of all events with cells of a given
+        size.
+        """
+        if cell_degrees not in self.geo_grids:
+            column = self.get_keyword_columns(reader, ['allPoints'])['allPoints']
+            self.geo_grids[cell_degrees] = build_geo_grid(column, self.num_docs, cell_degrees)
+        return self.geo_grids[cell_degrees]
+
+    def get_constraint_masks(self, max_size):
+        """
+        Gets the cache of per-constraint document masks for this generation.
+        """
+        if self.constraint_masks is None:
+            self.constraint_masks = MaskCache(self.num_docs, max_size)
+        return self.constraint_masks
+
+    def get_keyword_columns(self, reader, field_names):
+        """
+        Gets keyword columns for the given fields as a dictionary keyed by
+        field name, building any missing ones together in one pass.
+        """
+        missing = [f for f in set(field_names) if f not in self.keyword_columns]
+        if len(missing) > 0:
+            self.keyword_columns.update(build_keyword_columns(reader, missing))
+        return dict((f, self.keyword_columns[f]) for f in field_names)
+
+    def get_numeric_column(self, reader, field_name):
+        """
+        Gets an array of the values of a single-valued numeric field indexed by
+        document number. Documents without the field get zero.
+        """
+        if field_name not in self.numeric_columns:
+            column = self.get_keyword_columns(reader, [field_name])[field_name]
+            values = numpy.zeros(self.num_docs, dtype=numpy.int64)
+            values[column.entry_docnums] = numpy.array(column.values, dtype=numpy.int64)[column.value_ids]
+            self.numeric_columns[field_name] = values
+        return self.numeric_columns[field_name]
+
+    def get_year_order(self, reader):
+        """
+        Gets all document numbers ordered newest first, with ties in
+        decreasing document number order as Whoosh's reverse sorting gives,
+        along with the rank of each document number in that order.
+        """
+        if self.year_order is None:
+            years = self.get_numeric_column(reader, 'year')
+            order = numpy.lexsort((numpy.arange(self.num_docs), years))[::-1]
+            ranks = numpy.empty(self.num_docs, dtype=numpy.int64)
+            ranks[order] = numpy.arange(self.num_docs)
+            self.year_order = (order, ranks)
+        return self.year_order
+
+    def get_year_histogram(self, reader):
+        """
+        Gets the document counts by year.
+        """
+        if self.year_histogram is None:
+            column = self.get_keyword_columns(reader, ['year'])['year']
+            value_years = numpy.array(column.values, dtype=numpy.int64)
+            years, value_year_indexes = numpy.unique(value_years, return_inverse=True)
+            doc_year_indexes = numpy.full(self.num_docs, -1, dtype=numpy.int64)
+            has_value = numpy.diff(column.offsets) > 0
+            doc_year_indexes[has_value] = value_year_indexes[column.value_ids[column.offsets[:-1][has_value]]]
+            self.year_histogram = YearHistogram(years, doc_year_indexes)
+        return self.year_histogram
+
+    def get_entity_year_cube(self, reader, entity_field, cluster_field):
+        """
+        Gets the entity, year and cluster value incidence for an entity field
+        and a cluster field.
+        """
+        key = (entity_field, cluster_field)
+        if key not in self.entity_year_cubes:
+            columns = self.get_keyword_columns(reader, [entity_field, cluster_field])
+            years = self.get_numeric_column(reader, 'year')
+            self.entity_year_cubes[key] = EntityYearCube(columns[entity_field], columns[cluster_field], years)
+        return self.entity_year_cubes[key]
+
+    def get_lexicon(self, reader, field_name):
+        """
+        Gets the lexicon of a field for suggestions: the indexed terms of the
+        free text field, and otherwise the values of the keyword column, with
+        their counts over live documents.
+        """
+        if field_name not in self.lexicons:
+            if field_name == whooshutils.all_text_merge_field:
+                self.lexicons[field_name] = suggestions.lexicon_from_terms(reader, field_name, self.get_live_mask(reader))
+            else:
+                column = self.get_keyword_columns(reader, [field_name])[field_name]
+                self.lexicons[field_name] = suggestions.lexicon_from_column(column, self.get_live_mask(reader))
+        return self.lexicons[field_name]
+
+    def partitioned_columns(self):
+        """
+        Gets the columns built so far which can be counted over partitions of
+        the documents (see partitions.PartitionPool).
+        """
+        columns = self.keyword_columns.values() + self.level_refpoint_matrices.values() + self.entity_year_cubes.values()
+        if self.refpoint_matrix is not None:
+            columns.append(self.refpoint_matrix)
+        return columns
+
+    def build_like(self, reader, index_dir_path, other):
+        """
+        Builds the columns that another generation's columns have, which can
+        be counted over partitions, so that they are ready to register for
+        partition workers when the index changes.
+        """
+        self.get_keyword_columns(reader, other.keyword_columns.keys())
+        if other.refpoint_matrix is not None:
+            self.get_refpoint_matrix(reader, index_dir_path)
+        for level in other.level_refpoint_matrices:
+            self.get_level_refpoint_matrix(reader, index_dir_path, level)
+        for entity_field, cluster_field in other.entity_year_cubes:
+            self.get_entity_year_cube(reader, entity_field, cluster_field)
+
+class ColumnStore:
+    """
+    Keeps the columns for the latest generations of an index seen, dropping
+    the oldest when there are more than max_generations. Generations are told
+    apart by index identity, since a rebuilt index reuses generation numbers.
+    Keeping more than one means that queries still running on the old
+    generation when the index changes (see searchers.SearcherPool) do not
+    throw away the columns being built for the new one. One store can be
+    shared between any number of queriers on the same index.
+    """
+
+    def __init__(self, max_generations=2):
+        self.max_generations = max_generations
+        # Columns by index identity, oldest first
+        self.by_identity = collections.OrderedDict()
+
+    def for_reader(self, reader):
+        """
+        Gets the columns matching the index identity of a reader.
+        """
+        identity = whooshutils.reader_index_identity(reader)
+        columns = self.by_identity.get(identity)
+        if columns is None:
+            columns = self.by_identity[identity] = IndexColumns(reader.generation(), reader.doc_count_all(), identity)
+            while len(self.by_identity) > self.max_generations:
+                self.by_identity.popitem(last=False)
+        return columns
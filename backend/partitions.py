@@ -0,0 +1,251 @@
+"""
+Counting over partitions of the documents in parallel worker processes.
+"""
+
+import multiprocessing
+import os
+import time
+import weakref
+import numpy
+import scipy.sparse
+
+# Use gevent sleeping if available, since the backend normally runs in gevent
+# greenlets under uWSGI.
+try:
+    import gevent
+    _sleep = gevent.sleep
+except ImportError:
+    _sleep = time.sleep
+
+# Columns the worker processes can count on, by token (see
+# PartitionPool.register()). Workers get the columns registered before they
+# were forked, sharing their memory with the process they were forked from.
+_shared = weakref.WeakValueDictionary()
+
+def _unpack_mask(packed_mask, length):
+    return numpy.unpackbits(packed_mask)[:length].view(bool)
+
+def _partition_counts(token, method_name, packed_mask, start, length):
+    """
+    Counts a partition in a worker process, giving the keys with non-zero
+    counts and their counts.
+    """
+    counts = getattr(_shared[token], method_name)(_unpack_mask(packed_mask, length), start)
+    nonzero = numpy.flatnonzero(counts)
+    return nonzero, counts[nonzero]
+
+def _partition_links(token, packed_mask, start, length):
+    """
+    Counts the links of a partition in a worker process, giving the rows,
+    columns and counts of the non-zero entries of its link matrix.
+    """
+    links = _shared[token].link_matrix(_unpack_mask(packed_mask, length), start).tocoo()
+    return links.row, links.col, links.data
+
+def _partition_timeline_keys(token, value_ids, packed_mask, start, length):
+    """
+    Gets the timeline keys of a partition for each of several entity values
+    in a worker process.
+    """
+    cube, mask = _shared[token], _unpack_mask(packed_mask, length)
+    return [cube.timeline_keys(value_id, mask, start) for value_id in value_ids]
+
+class PartitionPool:
+    """
+    Pool of worker processes for counting over the matches of one query in
+    parallel. The document numbers are split into up to num_processes
+    consecutive partitions of at least min_partition_docs documents, each
+    worker counts one partition with only its part of the match mask, and the
+    partial counts are added up. With fewer than two partitions, or no
+    processes at all, counting is done in the calling process.
+
+    The workers use the columns of the calling process rather than copies:
+    they are forked from it and share its memory until either changes it.
+    Columns are registered up front for each version of the index (see
+    register()), and the workers are forked on first use after that, once
+    in each process using the pool. Columns not registered are counted in
+    the calling process. The workers forked before are stopped once the
+    partitions they were given are counted, rather than waited for, since
+    waiting would hold up every request of the process.
+    """
+
+    def __init__(self, num_processes=0, min_partition_docs=100000, poll_interval=0.002):
+        self.num_processes = num_processes
+        self.min_partition_docs = min_partition_docs
+        self.poll_interval = poll_interval
+        self.pool = None
+        # Process the pool belongs to
+        self.pool_pid = None
+        # Number of calls waiting for results of each pool of this process,
+        # and the pools replaced by newer workers
+        self.in_flight = {}
+        self.retired_pools = set()
+        # Token of each registered column, and the number of registrations
+        # adding columns so far and when the workers were forked
+        self.tokens = weakref.WeakKeyDictionary()
+        self.next_token = 0
+        self.registrations = 0
+        self.forked_registrations = 0
+        self.counters = {'partitioned': 0, 'inline': 0, 'unregistered': 0, 'forks': 0}
+
+    def register(self, index_columns):
+        """
+        Registers the columns built so far for a version of the index (an
+        indexcolumns.IndexColumns), for workers forked from now on. Done after
+        priming, and again when the index changes once the new version's
+        columns are built, so that the workers are forked once for each.
+        """
+        added = False
+        for column in index_columns.partitioned_columns():
+            if column not in self.tokens:
+                self.tokens[column] = self.next_token
+                _shared[self.next_token] = column
+                self.next_token += 1
+                added = True
+        if added:
+            self.registrations += 1
+
+    def _start_workers(self):
+        """
+        Forks the workers if they are not running in this process or columns
+        were registered since they were forked. Old workers of this process
+        are retired (see _retire()).
+        """
+        if self.pool_pid == os.getpid() and self.forked_registrations == self.registrations:
+            return
+        if self.pool_pid == os.getpid():
+            self._retire(self.pool)
+        else:
+            # Pools inherited from the process this one was forked from are
+            # left to it
+            self.in_flight = {}
+            self.retired_pools = set()
+        self.forked_registrations = self.registrations
+        self.pool = multiprocessing.Pool(self.num_processes)
+        self.pool_pid = os.getpid()
+        self.counters['forks'] += 1
+
+    def _retire(self, pool):
+        """
+        Stops the workers of a replaced pool once no calls are waiting for
+        their results: at once if none are, or else when the last of them has
+        its results (see _map()). Stopping idle workers does not wait for
+        anything to be counted.
+        """
+        if self.in_flight.get(pool, 0) > 0:
+            self.retired_pools.add(pool)
+        else:
+            pool.terminate()
+
+    def _plan(self, column, num_docs):
+        """
+        Gets the token the workers know a column by and the bounds of the
+        partitions to count num_docs documents in, or None to count in the
+        calling process instead.
+        """
+        num_partitions = min(self.num_processes, num_docs // max(1, self.min_partition_docs))
+        if num_partitions < 2:
+            self.counters['inline'] += 1
+            return None
+        token = self.tokens.get(column)
+        if token is None:
+            self.counters['unregistered'] += 1
+            return None
+        self._start_workers()
+        self.counters['partitioned'] += 1
+        return token, numpy.linspace(0, num_docs, num_partitions + 1).astype(numpy.int64)
+
+    def _map(self, function, args, mask, bounds):
+        """
+        Calls a worker function for each partition of a mask, and gets the
+        results in partition order. Waiting only sleeps the calling greenlet.
+        """
+        # Keeping the pool referenced until its results are in, in case the
+        # workers are forked again meanwhile (retiring the old pool)
+        pool = self.pool
+        self.in_flight[pool] = self.in_flight.get(pool, 0) + 1
+        try:
+            async_results = []
+            for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                async_results.append(pool.apply_async(function, args + (numpy.packbits(mask[start:end]), start, end - start)))
+            while not all(r.ready() for r in async_results):
+                _sleep(self.poll_interval)
+            return [r.get() for r in async_results]
+        finally:
+            self.in_flight[pool] -= 1
+            if self.in_flight[pool] == 0:
+                del self.in_flight[pool]
+                if pool in self.retired_pools:
+                    self.retired_pools.discard(pool)
+                    pool.terminate()
+
+    def _add_counts(self, token, method_name, mask, bounds, length):
+        counts = numpy.zeros(length, dtype=numpy.int64)
+        for keys, partition_counts in self._map(_partition_counts, (token, method_name), mask, bounds):
+            counts[keys] += partition_counts
+        return counts
+
+    def count(self, column, mask):
+        """
+        Counts the documents in a mask having each value of a keyword column,
+        as KeywordColumn.count() does.
+        """
+        plan = self._plan(column, len(mask))
+        if plan is None:
+            return column.count(mask)
+        token, bounds = plan
+        return self._add_counts(token, 'count_range', mask, bounds, len(column.values))
+
+    def refpoint_counts(self, refpoint_matrix, mask):
+        """
+        Counts the documents in a mask having each reference point, as
+        IncidenceMatrix.count_range() does.
+        """
+        plan = self._plan(refpoint_matrix, len(mask))
+        if plan is None:
+            return refpoint_matrix.count_range(mask)
+        token, bounds = plan
+        return self._add_counts(token, 'count_range', mask, bounds, len(refpoint_matrix.refpoints))
+
+    def link_matrix(self, refpoint_matrix, mask):
+        """
+        Counts the documents in a mask having each pair of distinct reference
+        points, as IncidenceMatrix.link_matrix() does.
+        """
+        plan = self._plan(refpoint_matrix, len(mask))
+        if plan is None:
+            return refpoint_matrix.link_matrix(mask)
+        token, bounds = plan
+        parts = self._map(_partition_links, (token,), mask, bounds)
+        num_refpoints = len(refpoint_matrix.refpoints)
+        # Duplicate entries are added up when converting
+        return scipy.sparse.coo_matrix((numpy.concatenate([data for rows, cols, data in parts]),
+                                        (numpy.concatenate([rows for rows, cols, data in parts]),
+                                         numpy.concatenate([cols for rows, cols, data in parts]))),
+                                       shape=(num_refpoints, num_refpoints)).tocsr()
+
+    def timeline_keys(self, cube, value_ids, mask):
+        """
+        Gets the timeline keys of the documents in a mask for each of several
+        entity values by value ID, as EntityYearCube.timeline_keys() does.
+        """
+        plan = self._plan(cube, len(mask))
+        if plan is None:
+            return [cube.timeline_keys(value_id, mask) for value_id in value_ids]
+        token, bounds = plan
+        parts = self._map(_partition_timeline_keys, (token, value_ids), mask, bounds)
+        return [numpy.unique(numpy.concatenate([keys[i] for keys in parts])) for i in range(len(value_ids))]
+
+    def close(self):
+        """
+        Stops the worker processes, if they were started, along with any
+        retired ones.
+        """
+        if self.pool_pid == os.getpid():
+            for pool in [self.pool] + list(self.retired_pools):
+                pool.terminate()
+                pool.join()
+        self.pool = None
+        self.pool_pid = None
+        self.in_flight = {}
+        self.retired_pools = set()
@@ -3,18 +3,40 @@ Query (frontend to backend) handling.
 """
 
 import whoosh
+import whoosh.collectors
 import whoosh.query
 import whoosh.sorting
 import whooshutils
+import indexcolumns
+import estimates
+import partitions
 import hashlib
+import base64
 import time
 import json
+import numpy
 
 from domain_config import domain_config, defaults
 
 import logging
 logger = logging.getLogger("query-logger")
 
+# Relative cost of each type of view per matching document, for estimating the
+# cost of a view before computing it (see Querier.view_cost()). Most views do
+# a few array operations over the matches; links multiply the reference points
+# of each match, and whole t-SNE layouts read the stored fields of each match.
+view_cost_weights = {
+    'countbyfieldvalue': 1,
+    'countbyyear': 1,
+    'countbyreferencepoint': 1,
+    'referencepointlinks': 4,
+    'descriptions': 1,
+    'tsnecoordinates': 50,
+    'tsnetext': 0,
+    'plottimeline': 1,
+    'suggestions': 0
+}
+
 class UnknownSetting(Exception):
   def __init__(self, setting):
     Exception.__init__(self, "unknown setting \"%s\"" % (setting))
@@ -27,6 +49,57 @@ class QueryHandlingError(Exception):
     def __init__(self, value):
         self.value = value
 
+class MatchingDocs(object):
+    """
+    The documents matching the constraints of a query, as a boolean mask over
+    document numbers, along with the searcher and columns the mask is valid
+    for. The mask is only evaluated when first needed, so a query answered
+    entirely from caches does not evaluate its constraints.
+    """
+
+    def __init__(self, searcher, columns, evaluate, key, unconstrained=False, estimate=None, constraints=None):
+        self.searcher = searcher
+        self.reader = searcher.reader()
+        self.columns = columns
+        # The constraints as JSON (as python objects), so that the matches can
+        # be evaluated again in another process
+        self.constraints = constraints
+        # String identifying the constraint set, for use in cache keys
+        self.key = key
+        # True if there are no constraints, so that the matches are all live
+        # documents and views can use precomputed results over all of them
+        self.unconstrained = unconstrained
+        self._evaluate = evaluate
+        self._estimate = estimate
+        self._mask = None
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            self._mask = self._evaluate()
+        return self._mask
+
+    def docnums(self):
+        """
+        Gets the matching document numbers in increasing order.
+        """
+        return numpy.flatnonzero(self.mask)
+
+    def estimated_count(self):
+        """
+        Gets an upper bound on the number of matching documents without
+        evaluating the mask, or the exact number if it is already evaluated.
+        """
+        if self._mask is not None or self._estimate is None:
+            return int(numpy.count_nonzero(self.mask))
+        return self._estimate()
+
+def make_query_parser(schema):
+    """
+    Makes the parser for text search constraints.
+    """
+    return whooshutils.TextQueryParser(schema=schema, field_map=domain_config.field_name_aliases)
+
 class Querier:
     """
     Query handler. Should be able to operate independently of any other query
@@ -34,23 +107,47 @@ class Querier:
     """
 
     def __init__(self, whoosh_index, cache, tracking_code="[Anonymous]",
-                 **our_settings):
+                 columns=None, flights=None, admission=None, searchers=None,
+                 query_parser=None, executor=None, partition_pool=None, **our_settings):
         """
         Make new querier. All arguments are keyword arguments. See the comments
         in the method body for more information.
         """
 
         self.whoosh_index = whoosh_index
+        # Directory of the index, for extra data files kept alongside it
+        self.index_dir_path = getattr(whoosh_index.storage, 'folder', None)
         self.__apply(our_settings,
                 defaults.settings['querier'],
                 domain_config.settings['querier'])
 
         self.cache = cache
+        # Column store for counting; shared between queriers on the same index
+        # so that the columns are built only once per index generation.
+        self.columns = columns if columns is not None else indexcolumns.ColumnStore()
+        # Optional querycache.SingleFlight shared between queriers, so that
+        # concurrent requests for the same uncached view result only compute
+        # it once.
+        self.flights = flights
+        # Optional admission.AdmissionControl shared between queriers, bounding
+        # the estimated cost of the views being computed at once in the process.
+        self.admission = admission
+        # Optional searchers.SearcherPool shared between queriers, so that
+        # queries use long-lived searchers rather than opening the index.
+        self.searchers = searchers
+        # Optional executor.QueryExecutor shared between queriers, computing
+        # uncached view results in worker processes so that they do not hold
+        # up the other requests of the process.
+        self.executor = executor
+        # Pool for counting over partitions of the matches in parallel (see
+        # partitions.py); by default counting is done in this process.
+        self.partition_pool = partition_pool if partition_pool is not None else partitions.PartitionPool()
 
         self.tracking_code = tracking_code
 
-        self.query_parser = whooshutils.TextQueryParser(schema=whoosh_index.schema,
-                field_map=domain_config.field_name_aliases)
+        # The text query parser can be shared between queriers on the same
+        # index, since it keeps no state between queries.
+        self.query_parser = query_parser if query_parser is not None else make_query_parser(whoosh_index.schema)
 
     def __apply(self, settings, *defaults):
       """
@@ -73,15 +170,86 @@ class Querier:
         query: The whole query being processed.
         views: The particular view to consider caching.
         """
+        # Storyline results are small and the same entities are asked for
+        # repeatedly as the storyline is explored, so cache them under any
+        # constraints.
+        if view["type"] == "plottimeline":
+            return True
+
+        # Map views for a viewport differ with every pan of the map, and
+        # suggestions with every keystroke
+        if "bounds" in view or view["type"] == "suggestions":
+            return False
+
         no_constraints = len(query["constraints"]) == 0
         page = int(view.get("page", 0))
 
         should_cache_page = True
         if view["type"] == "descriptions":
-            should_cache_page = page < self.num_initial_description_pages_to_cache
+            should_cache_page = page < self.num_initial_description_pages_to_cache and "cursor" not in view
 
         return no_constraints and should_cache_page
 
+    def cache_timeout(self, query, view):
+        """
+        Gets the timeout to cache the result of a view with, or None for the
+        cache's default. Plottimeline results under constraints expire, since
+        they are cached for every combination of constraints.
+        """
+        if view["type"] == "plottimeline" and len(query["constraints"]) > 0:
+            return self.constrained_plottimeline_cache_timeout
+        return None
+
+    def view_cache_json(self, view):
+        """
+        Gets the JSON identifying a view in result cache keys. Keys are
+        sorted, so that a view gives the same JSON however its dictionary was
+        built (see cached_view_ids()). Plottimeline views are normalized so
+        that the same entities and co-occurrence fields given in any order
+        share a cached result.
+        """
+        if view["type"] == "plottimeline":
+            view = dict(view)
+            view["entities"] = dict((f, sorted(set(vs))) for f, vs in view["entities"].iteritems())
+            if "cooccurrenceFields" in view:
+                view["cooccurrenceFields"] = sorted(set(view["cooccurrenceFields"]))
+        return json.dumps(view, sort_keys=True)
+
+    def constraints_cache_hash(self, query):
+        """
+        Gets the hash of the constraints of a query which the result cache key
+        of each of its views extends (see view_cache_key()).
+        """
+        # This is inefficient but works to generate cache keys. For each view we
+        # will use an SHA keys across the stringified JSON for all the
+        # constraints and that view.
+        constraints_hash = hashlib.sha1()
+        for constraint in query['constraints'].iteritems():
+            constraints_hash.update(json.dumps(constraint))
+        return constraints_hash
+
+    def view_cache_key(self, constraints_hash, view):
+        h = constraints_hash.copy()
+        h.update(self.view_cache_json(view))
+        return h.hexdigest()
+
+    def cached_view_ids(self, query):
+        """
+        Gets the IDs of the views of a query whose results handle_all_views()
+        would find in the cache rather than computing them.
+        """
+        constraints_hash = self.constraints_cache_hash(query)
+        cached = set()
+        for view_id, view in query['views'].iteritems():
+            if self.how_to_paginate_results(query, view) is not None:
+                # Cached before pagination, as in handle_all_views()
+                view = dict((k, v) for k, v in view.iteritems() if k not in ['page', 'requiredkeys'])
+            elif not self.should_cache(query, view):
+                continue
+            if self.cache.get(self.view_cache_key(constraints_hash, view)) is not None:
+                cached.add(view_id)
+        return cached
+
     def queries_to_prime(self):
         """
         Generator for all queries to prime caches with.
@@ -94,6 +262,11 @@ class Querier:
             yield {'type': 'referencepointlinks'}
             yield {'type': 'descriptions'}
             yield {'type': 'tsnecoordinates'}
+            # Not cached, but builds the lexicons so the first suggestions
+            # are fast
+            for field in self.fields_to_prime:
+                yield {'type': 'suggestions', 'field': field}
+            yield {'type': 'suggestions'}
             for page_num in range(self.num_initial_description_pages_to_cache):
                 yield {'type': 'descriptions', 'page': page_num}
         yield {'constraints': {}, 'views': dict((i, v) for i, v in enumerate(views_for_initial()))}
@@ -147,126 +320,568 @@ class Querier:
         else:
             raise ValueError("unknown constraint type \"%s\"" % (type))
 
-    def handle_all_constraints(self, query):
+    def constraint_to_mask(self, cnstr, searcher, columns):
+        """
+        Produces the document mask for a single constraint. Geographic and
+        t-SNE regions are looked up in grid indexes of the points, event IDs
+        are mapped directly to document numbers, and other constraints are
+        searched for with Whoosh.
+        """
+        type = cnstr['type']
+        if type == 'geobox':
+            geo_grid = columns.get_geo_grid(searcher.reader(), self.geo_grid_cell_degrees)
+            return reduce(numpy.logical_or, [geo_grid.box_mask(*box) for box in self._geobox_boxes(cnstr)])
+        elif type == 'geopolygon':
+            if len(cnstr['points']) < 3:
+                raise QueryHandlingError("geopolygon needs at least three points")
+            geo_grid = columns.get_geo_grid(searcher.reader(), self.geo_grid_cell_degrees)
+            return geo_grid.polygon_mask(cnstr['points'])
+        elif type == 'tsneCoordinates':
+            # Event IDs map straight to document numbers
+            id_docnums = columns.get_id_docnums(searcher.reader())
+            ids = numpy.array([int(p) for p in cnstr['points']], dtype=numpy.int64)
+            docnums = id_docnums[ids[(ids >= 0) & (ids < len(id_docnums))]]
+            return columns.mask(docnums[docnums >= 0])
+        elif type == 'tsnePolygon':
+            if len(cnstr['points']) < 3:
+                raise QueryHandlingError("tsnePolygon needs at least three points")
+            tsne_coordinates = columns.get_tsne_coordinates(searcher.reader(), self.index_dir_path)
+            return tsne_coordinates.grid(self.tsne_grid_cells).polygon_mask(cnstr['points'])
+        elif type == 'referencepoints' and 'zoom' in cnstr:
+            cnstr = self._expand_refpoints_constraint(cnstr, columns)
+        return columns.mask(self._search_docs(searcher, self.constraint_to_whoosh_query(cnstr)))
+
+    def _geobox_boxes(self, cnstr):
+        """
+        Gets the (west, south, east, north) boxes covering a geobox constraint:
+        two for a box wrapping around the antimeridian, and otherwise one.
+        """
+        west, south, east, north = [float(cnstr[k]) for k in ['west', 'south', 'east', 'north']]
+        if west > east:
+            return [(west, south, 180.0, north), (-180.0, south, east, north)]
+        return [(west, south, east, north)]
+
+    def _expand_refpoints_constraint(self, cnstr, columns):
         """
-        Generate the Whoosh query object for the constraints.
+        Rewrites a reference points constraint at a zoom level in terms of the
+        reference points themselves, since points of a coarser level stand for
+        all the reference points under them.
         """
-        def handle_constraint(cnstr_id, cnstr):
-            logger.debug(self.tracking_code + " handling constraint \"%s\" of type \"%s\"" % (cnstr_id, cnstr['type']))
-            return self.constraint_to_whoosh_query(cnstr)
-        return whoosh.query.And([handle_constraint(cid, c) for cid, c in query['constraints'].iteritems()]) if len(query['constraints']) > 0 else whoosh.query.Every()
+        levels = columns.get_refpoint_levels(self.index_dir_path)
+        return dict(cnstr, points=levels.expand(cnstr['points'], int(cnstr['zoom'])))
 
-    def generate_field_counts(self, response, views, whoosh_query):
+    def _search_docs(self, searcher, whoosh_query):
+        """
+        Gets the document numbers matching a Whoosh query, giving up with an
+        error if the search takes longer than the constraint time limit.
+        """
+        if self.constraint_time_limit is None:
+            return searcher.docs_for_query(whoosh_query)
+        # Signals only work in the main thread, so the timer is only checked
+        # between matches
+        collector = whoosh.collectors.TimeLimitCollector(searcher.collector(limit=None, scored=False), self.constraint_time_limit, use_alarm=False)
+        try:
+            searcher.search_with_collector(whoosh_query, collector)
+        except whoosh.collectors.TimeLimit:
+            raise QueryHandlingError("constraint took too long to search")
+        return collector.results().docs()
+
+    def constraint_size_estimate(self, cnstr, reader, columns):
+        """
+        Estimates an upper bound on the number of documents matching a
+        constraint without evaluating it. Geographic and t-SNE regions are
+        bounded by the number of points in the grid cells covering their
+        bounding boxes, and other constraints by the lengths of the posting
+        lists of the Whoosh query for them.
+        """
+        type = cnstr['type']
+        try:
+            if type == 'geobox':
+                geo_grid = columns.get_geo_grid(reader, self.geo_grid_cell_degrees)
+                size = sum(geo_grid.box_size_estimate(*box) for box in self._geobox_boxes(cnstr))
+            elif type == 'geopolygon':
+                size = columns.get_geo_grid(reader, self.geo_grid_cell_degrees).polygon_size_estimate(cnstr['points'])
+            elif type == 'tsnePolygon':
+                tsne_coordinates = columns.get_tsne_coordinates(reader, self.index_dir_path)
+                size = tsne_coordinates.grid(self.tsne_grid_cells).polygon_size_estimate(cnstr['points'])
+            else:
+                if type == 'referencepoints' and 'zoom' in cnstr:
+                    cnstr = self._expand_refpoints_constraint(cnstr, columns)
+                size = self.constraint_to_whoosh_query(cnstr).estimate_size(reader)
+            return min(reader.doc_count(), size)
+        except Exception:
+            # Any problem with the constraint is reported when evaluating it
+            return reader.doc_count()
+
+    def _matches_estimator(self, constraints, reader, columns):
+        """
+        Makes a function estimating an upper bound on the number of documents
+        matching all of a set of constraints (see MatchingDocs).
+        """
+        def estimate():
+            return min([reader.doc_count()] + [self.constraint_size_estimate(c, reader, columns) for c in constraints.itervalues()])
+        return estimate
+
+    def view_cost(self, view, num_matches):
+        """
+        Estimates the cost of computing a view for a number of matching
+        documents, in units of about a matching document per array operation
+        (see view_cost_weights).
+        """
+        type = view['type']
+        weight = view_cost_weights.get(type, 1)
+        if type == 'tsnecoordinates' and any(k in view for k in ['bounds', 'zoom', 'maxPoints']):
+            # Viewports work on the coordinates column
+            weight = 1
+        elif type == 'plottimeline' and 'cooccurrences' in view:
+            weight += len(view.get('cooccurrenceFields', []))
+        return weight * num_matches
+
+    def _too_expensive_result(self, view, matches):
+        """
+        Gets the error result for a view whose estimated cost is over the
+        maximum view cost, or None if it can be computed. Views without
+        constraints are not limited, since their results are cached.
+        """
+        if self.max_view_cost is None or matches.unconstrained:
+            return None
+        cost = self.view_cost(view, matches.estimated_count())
+        if cost <= self.max_view_cost:
+            return None
+        logger.warn(self.tracking_code + " refusing view of type \"%s\" with estimated cost %i" % (view['type'], cost))
+        return {'error': "query too expensive; try adding constraints", 'tooExpensive': {'cost': cost, 'maxCost': self.max_view_cost}}
+
+    def _constraint_handler(self, query, searcher, columns):
+        """
+        Makes a function getting the document mask for a constraint of a query
+        by ID. Each constraint is resolved to a mask on its own and cached keyed
+        by its JSON, so a query differing from a recent one by a single
+        constraint only evaluates that constraint.
+        """
+        constraint_masks = columns.get_constraint_masks(self.constraint_cache_size)
+
+        def handle_constraint(cnstr_id):
+            cnstr = query['constraints'][cnstr_id]
+            key = json.dumps(cnstr, sort_keys=True)
+            mask = constraint_masks.get(key)
+            if mask is None:
+                logger.debug(self.tracking_code + " handling constraint \"%s\" of type \"%s\"" % (cnstr_id, cnstr['type']))
+                mask = self.constraint_to_mask(cnstr, searcher, columns)
+                constraint_masks.set(key, mask)
+            else:
+                logger.debug(self.tracking_code + " handling constraint \"%s\" of type \"%s\": using cache" % (cnstr_id, cnstr['type']))
+            return mask
+
+        return handle_constraint
+
+    def _constraints_key(self, constraints):
+        """
+        Makes a string identifying a set of constraints (see MatchingDocs).
+        """
+        return json.dumps(sorted(json.dumps(c, sort_keys=True) for c in constraints.itervalues()))
+
+    def handle_all_constraints(self, query, searcher):
+        """
+        Get the documents matching all the constraints, as the intersection of
+        the masks for each constraint.
+        """
+        reader = searcher.reader()
+        columns = self.columns.for_reader(reader)
+        handle_constraint = self._constraint_handler(query, searcher, columns)
+
+        def evaluate():
+            mask = columns.get_live_mask(reader).copy()
+            for cnstr_id in query['constraints']:
+                mask &= handle_constraint(cnstr_id)
+            return mask
+
+        return MatchingDocs(searcher, columns, evaluate, self._constraints_key(query['constraints']), len(query['constraints']) == 0,
+                            self._matches_estimator(query['constraints'], reader, columns), query['constraints'])
+
+    def handle_variant_constraints(self, query, searcher):
+        """
+        Get the documents matching each variant of a query, where each variant
+        leaves out some of the constraints. Returns matching documents by
+        variant ID.
+
+        When the left out sets of constraints don't overlap (as when each
+        frontend tab leaves out its own constraints), the matches for leaving
+        out each set are found together from prefix and suffix intersections of
+        the sets' masks: the match leaving out set k is the intersection of the
+        constraints in no set, the prefix of sets before k and the suffix of
+        sets after k. This takes a number of intersections linear in the
+        number of constraints rather than one per constraint per variant.
+        Otherwise each variant is intersected on its own.
+        """
+        reader = searcher.reader()
+        columns = self.columns.for_reader(reader)
+        handle_constraint = self._constraint_handler(query, searcher, columns)
+        constraint_ids = set(query['constraints'])
+        excludes = dict((variant_id, frozenset(variant.get('exclude', [])) & constraint_ids) for variant_id, variant in query['variants'].iteritems())
+        groups = sorted(set(e for e in excludes.itervalues() if len(e) > 0), key=sorted)
+        grouped_ids = frozenset().union(*groups)
+        variant_masks = {}
+
+        def intersect(mask, cnstr_ids):
+            for cnstr_id in cnstr_ids:
+                mask &= handle_constraint(cnstr_id)
+            return mask
+
+        def evaluate_all():
+            live_mask = columns.get_live_mask(reader)
+            if sum(len(g) for g in groups) == len(grouped_ids):
+                group_masks = [intersect(live_mask.copy(), g) for g in groups]
+                prefixes = [intersect(live_mask.copy(), constraint_ids - grouped_ids)]
+                for group_mask in group_masks:
+                    prefixes.append(prefixes[-1] & group_mask)
+                suffixes = [None] * (len(groups) + 1)
+                for k in reversed(range(len(groups))):
+                    suffixes[k] = group_masks[k] if suffixes[k + 1] is None else group_masks[k] & suffixes[k + 1]
+                left_out_masks = {}
+                for k, group in enumerate(groups):
+                    left_out_masks[group] = prefixes[k] if suffixes[k + 1] is None else prefixes[k] & suffixes[k + 1]
+                left_out_masks[frozenset()] = prefixes[-1]
+                logger.debug(self.tracking_code + " evaluated %i variants from %i left out constraint sets" % (len(excludes), len(groups)))
+                for variant_id, exclude in excludes.iteritems():
+                    variant_masks[variant_id] = left_out_masks[exclude]
+            else:
+                for variant_id, exclude in excludes.iteritems():
+                    variant_masks[variant_id] = intersect(live_mask.copy(), constraint_ids - exclude)
+
+        def evaluator(variant_id):
+            def evaluate():
+                if len(variant_masks) == 0:
+                    evaluate_all()
+                return variant_masks[variant_id]
+            return evaluate
+
+        variant_matches = {}
+        for variant_id, exclude in excludes.iteritems():
+            constraints = dict((cid, c) for cid, c in query['constraints'].iteritems() if cid not in exclude)
+            variant_matches[variant_id] = MatchingDocs(searcher, columns, evaluator(variant_id), self._constraints_key(constraints), len(constraints) == 0,
+                                                       self._matches_estimator(constraints, reader, columns), constraints)
+        return variant_matches
+
+    def handle_all_variants(self, query, searcher):
+        """
+        Handles the views of each variant of a query (see
+        handle_variant_constraints()), giving a response for each variant
+        keyed by variant ID. Each variant is cached as if it was a query of its
+        own with only the constraints it keeps.
+        """
+        variant_matches = self.handle_variant_constraints(query, searcher)
+        response = {}
+        for variant_id, variant in query['variants'].iteritems():
+            exclude = set(variant.get('exclude', []))
+            variant_query = {
+                'constraints': dict((cid, c) for cid, c in query['constraints'].iteritems() if cid not in exclude),
+                'views': variant['views']
+            }
+            response[variant_id] = self.handle_all_views(variant_query, variant_matches[variant_id])
+        return response
+
+    def generate_field_counts(self, response, views, matches):
         """
         Handles all the count by field value views for a query. All values of a
-        multiple-valued field are counted.
+        multiple-valued field are counted. Counting is done on the column store
+        using only the mask of matching documents, so no stored fields are read.
+        Only the most frequent count_by_field_value_max_values values are
+        kept, unless the view asks for all values, with the number of values
+        given if any were left out.
         """
 
         logger.debug(self.tracking_code + " generating field counts for fields: %s" % (' '.join(v['field'] for v in views.itervalues())))
 
-        for view_id, view in views.iteritems():
-            response[view_id] = {'counts': {}}
-
-        logger.debug(self.tracking_code + " whoosh_query: " + repr(whoosh_query))
         logger.debug(self.tracking_code + " view: " + json.dumps(views))
 
-        with self.whoosh_index.searcher() as searcher:
-            hits = searcher.search(whoosh_query, limit=None)
-            logger.info(self.tracking_code + " whoosh search results: %s" % (repr(hits)))
-            for hit in hits:
-                for view_id, view in views.iteritems():
-                    field = view['field']
-                    field = domain_config.field_name_aliases(field) or field
-                    if field in hit:
-                        values = set(v for v in whooshutils.split_keywords(hit[field]))
-                        counts = response[view_id]['counts']
-                        for value in values:
-                            counts.setdefault(value, 0)
-                            counts[value] += 1
+        fields = dict((view_id, domain_config.field_name_aliases(view['field']) or view['field']) for view_id, view in views.iteritems())
+        field_columns = matches.columns.get_keyword_columns(matches.reader, fields.values())
+        logger.info(self.tracking_code + " matching documents: %i" % (matches.mask.sum()))
+        for view_id, field in fields.iteritems():
+            max_values = None if views[view_id].get('allvalues', False) else self.count_by_field_value_max_values
+            column = field_columns[field]
+            counts, num_values = column.top_counts(matches.mask, max_values, self.partition_pool.count(column, matches.mask))
+            response[view_id] = {'counts': counts}
+            if num_values > len(counts):
+                response[view_id]['numValues'] = num_values
+
+    def _count_field_values(self, view, matches, values):
+        """
+        Counts the matches having each of the given values of a count by field
+        value view's field, as (value, count) pairs for the values with
+        non-zero counts in the order of a full count result.
+        """
+        field = domain_config.field_name_aliases(view['field']) or view['field']
+        column = matches.columns.get_keyword_columns(matches.reader, [field])[field]
+        counts = column.value_counts(matches.mask, values)
+        counts.sort(key=lambda (value, count): (-count, column.value_index[value]))
+        return counts
 
-        for view_id, view in views.iteritems():
-            counts = response[view_id]['counts'].items()
-            counts.sort(key=lambda (v, c): c, reverse=True)
-            response[view_id]['counts'] = counts
-
-    def _handle_descriptions_view(self, view, whoosh_query):
-        page_num = view['page'] if 'page' in view else 0
-        result = {'more': True}
-
-        with self.whoosh_index.searcher() as searcher:
-            def format(hit):
-                return dict((f, hit[f]) for f in domain_config.description_field_names)
-            hits = searcher.search_page(whoosh_query, page_num + 1, pagelen=self.description_page_size, sortedby='year', reverse=True)
-            logger.debug(self.tracking_code + " whoosh pre-paginated search results: %s" % (repr(hits.results)))
-            result['descriptions'] = [format(h) for h in hits]
-            if hits.is_last_page():
-                result['more'] = False
+    def _description_cursor(self, matches, docnum):
+        """
+        Makes the opaque cursor for continuing descriptions after a document.
+        """
+        year = matches.columns.get_numeric_column(matches.reader, 'year')[docnum]
+        return base64.urlsafe_b64encode("%s,%i,%i" % (matches.columns.identity, year, docnum))
 
+    def _seek_description_cursor(self, cursor, matches):
+        """
+        Finds the position in the newest first document order to continue
+        descriptions from for a cursor. If the index has changed since the
+        cursor was made, its document number is meaningless, so continue from
+        the first document older than its year.
+        """
+        order, ranks = matches.columns.get_year_order(matches.reader)
+        try:
+            identity, year, docnum = base64.urlsafe_b64decode(str(cursor)).split(',')
+            year, docnum = int(year), int(docnum)
+        except (TypeError, ValueError):
+            raise QueryHandlingError("invalid descriptions cursor")
+        if identity == matches.columns.identity and 0 <= docnum < len(ranks):
+            return ranks[docnum] + 1
+        years = matches.columns.get_numeric_column(matches.reader, 'year')
+        return numpy.searchsorted(-years[order], -year, side='right')
+
+    def _handle_descriptions_view(self, view, matches):
+        """
+        Gets a page of event descriptions, newest first. Pages are found in the
+        precomputed newest first order of all documents. A page after a cursor
+        (from the previous page's result) is found by scanning forward from the
+        cursor's position in growing chunks until the page is full, so the cost
+        depends on the page size rather than on the number of matches or how
+        deep the page is. Pages by number need all matches to be put in order.
+        """
+        order, ranks = matches.columns.get_year_order(matches.reader)
+        mask = matches.mask
+        page_size = self.description_page_size
+
+        if 'cursor' in view:
+            position = self._seek_description_cursor(view['cursor'], matches)
+            chunk_size = max(2 * page_size, 64)
+            found = []
+            num_found = 0
+            while position < len(order) and num_found <= page_size:
+                chunk = order[position:position + chunk_size]
+                found.append(chunk[mask[chunk]])
+                num_found += len(found[-1])
+                position += chunk_size
+                chunk_size *= 2
+            hits = numpy.concatenate(found) if len(found) > 0 else numpy.zeros(0, dtype=numpy.int64)
+            page = hits[:page_size]
+            more = len(hits) > page_size
+        else:
+            page_num = view['page'] if 'page' in view else 0
+            page_start = page_num * page_size
+            ordered = order[mask[order]]
+            page = ordered[page_start:page_start + page_size]
+            more = page_start + len(page) < len(ordered)
+
+        def format(hit):
+            return dict((f, hit[f]) for f in domain_config.description_field_names)
+        result = {
+            'descriptions': [format(matches.reader.stored_fields(d)) for d in page],
+            'more': more
+        }
+        if more and len(page) > 0:
+            result['cursor'] = self._description_cursor(matches, page[-1])
         return result
 
-    def _handle_referencepointlinks_view(self, view, whoosh_query):
-        link_counts = {}
-        with self.whoosh_index.searcher() as searcher:
-            hits = searcher.search(whoosh_query, limit=None)
-            logger.debug(self.tracking_code + " whoosh search results: %s" % (repr(hits)))
-            for hit in hits:
-                refpoints = whooshutils.split_keywords(hit['referencePoints'])
-                for i, refpoint1 in enumerate(refpoints):
-                    for refpoint2 in refpoints[i+1:]:
-                        if refpoint1 != refpoint2:
-                            # Use lexicographic order to guarantee unique choices of two distinct reference points
-                            pair = (refpoint1, refpoint2) if refpoint1 < refpoint2 else (refpoint2, refpoint1)
-                            link_counts.setdefault(pair, 0)
-                            link_counts[pair] += 1
+    def _handle_countbyyear_view(self, view, matches):
+        """
+        Counts matches by year, or by buckets of years if the view gives a
+        bucket size or a maximum number of buckets. Counts over all documents
+        come from precomputed prefix sums, and others from a histogram of the
+        mask.
+        """
+        histogram = matches.columns.get_year_histogram(matches.reader)
+        if 'bucketsize' in view:
+            bucket_size = int(view['bucketsize'])
+            if bucket_size < 1:
+                raise QueryHandlingError("bucketsize must be at least one year")
+        elif 'maxbuckets' in view:
+            max_buckets = int(view['maxbuckets'])
+            if max_buckets < 1:
+                raise QueryHandlingError("maxbuckets must be at least one")
+            bucket_size = histogram.bucket_size_for(max_buckets)
+        else:
+            bucket_size = 1
+
+        counts = histogram.counts(None if matches.unconstrained else matches.mask, bucket_size)
+        result = {'counts': counts}
+        if 'bucketsize' in view or 'maxbuckets' in view:
+            result['bucketsize'] = bucket_size
+        return result
+
+    def _refpoint_view_matrix(self, view, matches):
+        """
+        Gets the reference point incidence matrix for the zoom level of a map
+        view (the finest level if not given), and the mask of its reference
+        points within the view's bounds (None if not given).
+        """
+        levels = matches.columns.get_refpoint_levels(self.index_dir_path)
+        level = max(0, min(int(view.get('zoom', levels.num_levels)), levels.num_levels))
+        refpoint_matrix = matches.columns.get_level_refpoint_matrix(matches.reader, self.index_dir_path, level)
+        within = refpoint_matrix.refpoints_within(view['bounds']) if 'bounds' in view else None
+        return refpoint_matrix, within
+
+    def _handle_countbyreferencepoint_view(self, view, matches):
+        refpoint_matrix, within = self._refpoint_view_matrix(view, matches)
+        return {
+            'counts': refpoint_matrix.sorted_counts(matches.mask, within, self.partition_pool.refpoint_counts(refpoint_matrix, matches.mask))
+        }
+
+    def _handle_referencepointlinks_view(self, view, matches):
+        refpoint_matrix, within = self._refpoint_view_matrix(view, matches)
         return {
-            'links': [{'refpoints': p, 'count': c} for (p, c) in link_counts.iteritems()]
+            'links': [{'refpoints': p, 'count': c} for (p, c) in refpoint_matrix.link_counts(matches.mask, within, self.partition_pool.link_matrix(refpoint_matrix, matches.mask))]
         }
 
-    def _handle_tsnecoordinates_view(self, view, whoosh_query):
-        cache_key = hashlib.md5(json.dumps(view)+repr(whoosh_query)).hexdigest()
-        counts_raw = self.cache.get(cache_key)
+    def _handle_tsnecoordinates_view(self, view, matches):
+        cache_key = hashlib.md5(json.dumps(view)+matches.key).hexdigest()
+        is_viewport = any(k in view for k in ['bounds', 'zoom', 'maxPoints'])
+        # Viewport results are only cached for the whole layout, since every
+        # pan of the viewport gives different bounds.
+        should_cache = not is_viewport or 'bounds' not in view
+        counts_raw = self.cache.get(cache_key) if should_cache else None
 
         if counts_raw is not None:
             return json.loads(counts_raw)
+        if is_viewport:
+            result = self._tsne_viewport(view, matches)
         else:
-            coordinates = {}
-            with self.whoosh_index.searcher() as searcher:
-                hits = searcher.search(whoosh_query, limit=None)
-                logger.debug(self.tracking_code + " whoosh search results: %s" % (repr(hits)))
-                for hit in hits:
-                    if '2DtSNECoordinates' in hit:
-                        refpoints = whooshutils.split_keywords(hit['2DtSNECoordinates'])
-                        id = hit['id']
-                        sentence = hit['sentence']
-                        for refpoint in refpoints:
-                            if refpoint:
-                                coordinate_splits = whooshutils.split_keywords(refpoint)
-                                coordinates[id] = {'x': coordinate_splits[0], 'y': coordinate_splits[1], 'text': sentence}
-            result = {
-                'coordinates': [{'id': i, 'coordinates': {'x': p['x'], 'y': p['y']}, 'text': p['text']} for i, p in coordinates.iteritems()]
+            result = self._tsne_layout(matches)
+        if should_cache and not result.get('partial', False):
+            self.cache.set(cache_key, json.dumps(result))
+        return result
+
+    def _tsne_layout(self, matches):
+        """
+        Gets the t-SNE coordinates and text of all matching documents from
+        their stored fields, as a partial result if the view time limit is
+        reached first.
+        """
+        coordinates = {}
+        docnums = numpy.flatnonzero(matches.mask)
+        deadline = time.time() + self.view_time_limit if self.view_time_limit is not None else None
+        partial = False
+        for i, docnum in enumerate(docnums):
+            if deadline is not None and i % 100 == 0 and time.time() > deadline:
+                logger.warn(self.tracking_code + " view time limit reached after reading %i of %i documents" % (i, len(docnums)))
+                partial = True
+                break
+            hit = matches.reader.stored_fields(docnum)
+            if '2DtSNECoordinates' in hit:
+                refpoints = whooshutils.split_keywords(hit['2DtSNECoordinates'])
+                id = hit['id']
+                sentence = hit['sentence']
+                for refpoint in refpoints:
+                    if refpoint:
+                        coordinate_splits = whooshutils.split_keywords(refpoint)
+                        coordinates[id] = {'x': coordinate_splits[0], 'y': coordinate_splits[1], 'text': sentence}
+        result = {
+            'coordinates': [{'id': i, 'coordinates': {'x': p['x'], 'y': p['y']}, 'text': p['text']} for i, p in coordinates.iteritems()]
+        }
+        if partial:
+            result['partial'] = True
+        return result
+
+    def _tsne_viewport(self, view, matches):
+        """
+        Gets the matching t-SNE points within the viewport bounds of a view
+        from the coordinates column. If there are more than the point budget,
+        the points are instead counted in the bins of a grid over the whole
+        layout with 2^zoom bins on each side, so that bins line up as the
+        viewport moves.
+        """
+        tsne_coordinates = matches.columns.get_tsne_coordinates(matches.reader, self.index_dir_path)
+        ids, xs, ys = tsne_coordinates.points(matches.mask)
+        if 'bounds' in view:
+            bounds = view['bounds']
+            inside = (xs >= bounds['x0']) & (xs <= bounds['x1']) & (ys >= bounds['y0']) & (ys <= bounds['y1'])
+            ids, xs, ys = ids[inside], xs[inside], ys[inside]
+
+        max_points = min(int(view.get('maxPoints', self.tsne_max_points)), self.tsne_max_points)
+        if len(ids) <= max_points:
+            return {
+                'points': [{'id': i, 'x': x, 'y': y} for i, x, y in zip(ids.tolist(), xs.tolist(), ys.tolist())],
+                'numPoints': len(ids)
             }
 
-            self.cache.set(cache_key, json.dumps(result))
-            return result
+        min_x, min_y, max_x, max_y = tsne_coordinates.extent()
+        size = 2 ** max(0, min(int(view.get('zoom', 0)), self.tsne_max_zoom))
+        bin_width = (max_x - min_x) / size or 1.0
+        bin_height = (max_y - min_y) / size or 1.0
+        columns = numpy.clip(((xs - min_x) / bin_width).astype(numpy.int64), 0, size - 1)
+        rows = numpy.clip(((ys - min_y) / bin_height).astype(numpy.int64), 0, size - 1)
+        bins, bin_of_point = numpy.unique(columns * size + rows, return_inverse=True)
+        counts = numpy.bincount(bin_of_point)
+        # Mean position of the points in each bin, for drawing
+        mean_xs = numpy.bincount(bin_of_point, weights=xs) / counts
+        mean_ys = numpy.bincount(bin_of_point, weights=ys) / counts
+        return {
+            'bins': [{'column': b // size, 'row': b % size, 'count': c, 'x': x, 'y': y} for b, c, x, y in zip(bins.tolist(), counts.tolist(), mean_xs.tolist(), mean_ys.tolist())],
+            'grid': {'x': min_x, 'y': min_y, 'binWidth': bin_width, 'binHeight': bin_height, 'size': size},
+            'numPoints': len(ids)
+        }
+
+    def _handle_tsnetext_view(self, view, matches):
+        id_docnums = matches.columns.get_id_docnums(matches.reader)
+        ids = [int(i) for i in view['ids'][:self.tsne_max_points]]
+        texts = []
+        for id in ids:
+            if 0 <= id < len(id_docnums) and id_docnums[id] >= 0:
+                texts.append({'id': id, 'text': matches.reader.stored_fields(id_docnums[id]).get('sentence')})
+        return {'texts': texts}
+
+    def _handle_suggestions_view(self, view, matches):
+        """
+        Suggests completions of a typed prefix from the values of a field, or
+        from the free text search terms if no field is given, as (value,
+        document frequency) pairs. Suggestions are over the whole index and
+        ignore the constraints.
+        """
+        if 'field' in view:
+            field = domain_config.field_name_aliases(view['field']) or view['field']
+        else:
+            field = whooshutils.all_text_merge_field
+        if field not in matches.reader.schema:
+            raise QueryHandlingError("unknown field \"%s\"" % (field))
+        prefix = view.get('prefix', u'')
+        limit = max(0, min(int(view.get('limit', self.suggestion_limit)), self.suggestion_limit))
+        max_edits = self.suggestion_max_edits if view.get('fuzzy', False) and len(prefix) >= self.suggestion_fuzzy_min_length else 0
+
+        lexicon = matches.columns.get_lexicon(matches.reader, field)
+        return {'suggestions': lexicon.suggest(prefix, limit, max_edits, self.suggestion_max_fuzzy_candidates) if limit > 0 else []}
+
+    def _handle_plottimeline_view(self, view, matches):
+        reader, columns = matches.reader, matches.columns
+        deadline = time.time() + self.view_time_limit if self.view_time_limit is not None else None
+
+        def entities_mask(entities, is_disjunctive):
+            entity_columns = columns.get_keyword_columns(reader, entities.keys())
+            masks = [entity_columns[ef].mask_for_value(ev) for ef, evs in entities.iteritems() for ev in evs]
+            if len(masks) == 0:
+                return numpy.zeros(columns.num_docs, dtype=bool)
+            return reduce(numpy.logical_or if is_disjunctive else numpy.logical_and, masks)
 
-    def _handle_plottimeline_view(self, view, whoosh_query):
         def find_cooccurrences(entities, cooc_fields, need_field, is_disjunctive):
-            op = whoosh.query.Or if is_disjunctive else whoosh.query.And
-            rel_query = op([whoosh.query.Term(ef, ev) for ef, evs in entities.iteritems() for ev in evs])
-            with self.whoosh_index.searcher() as searcher:
-                hits = searcher.search(whoosh.query.And([whoosh_query, rel_query]), limit=None)
-                cooc_counts = {}
-                for hit in hits:
-                    if need_field in hit:
-                        for cooc_field in cooc_fields:
-                            known_field = cooc_field in entities
-                            for value in whooshutils.split_keywords(hit[cooc_field]):
-                                if not (known_field and value in entities[cooc_field]):
-                                    cooc_counts.setdefault((cooc_field, value), 0)
-                                    cooc_counts[cooc_field, value] += 1
-
-                cooc_counts = sorted(cooc_counts.iteritems(), key=lambda (e, c): c, reverse=True)
-                return cooc_counts[:self.plottimeline_max_cooccurring_entities], len(cooc_counts)
+            mask = matches.mask & entities_mask(entities, is_disjunctive)
+            mask &= columns.get_keyword_columns(reader, [need_field])[need_field].present
+            max_coocs = self.plottimeline_max_cooccurring_entities
+            cooc_counts = []
+            num_total_coocs = 0
+            for cooc_field, column in columns.get_keyword_columns(reader, cooc_fields).iteritems():
+                # Only the most frequent values of each field can be among the
+                # most frequent overall
+                known_values = set(entities.get(cooc_field, []))
+                top_counts, num_values = column.top_counts(mask, max_coocs + len(known_values), self.partition_pool.count(column, mask))
+                for value, count in top_counts:
+                    if value not in known_values:
+                        cooc_counts.append(((cooc_field, value), count))
+                num_total_coocs += num_values - len(column.value_counts(mask, known_values))
+
+            cooc_counts.sort(key=lambda (e, c): c, reverse=True)
+            return cooc_counts[:max_coocs], num_total_coocs
 
         result = {}
 
@@ -282,86 +897,88 @@ class Querier:
             result['numCooccurringEntities'] = num_total_coocs
             result['numIncludedCooccurringEntities'] = len(cooc_entities)
 
-        # Checking for cluster_field per hit below seems to be slightly faster (empirically) than including Every(cluster_field) in the query
-        rel_query = whoosh.query.Or([whoosh.query.Term(ef, ev) for ef, evs in entities.iteritems() for ev in evs])
-        timeline = dict((ef, dict((ev, {}) for ev in evs)) for ef, evs in entities.iteritems())
-        with self.whoosh_index.searcher() as searcher:
-            hits = searcher.search(whoosh.query.And([whoosh_query, rel_query]), limit=None)
-            for hit in hits:
-                if cluster_field in hit:
-                    year = int(hit['year'])
-                    cluster_values = set(whooshutils.split_keywords(hit[cluster_field]))
-                    for entity_field, entity_values in entities.iteritems():
-                        hit_entity_values = set(whooshutils.split_keywords(hit[entity_field]))
-                        for entity_value in entity_values:
-                            if entity_value in hit_entity_values:
-                                timeline[entity_field][entity_value].setdefault(year, set())
-                                timeline[entity_field][entity_value][year] |= cluster_values
+        timeline = {}
         for entity_field, entity_values in entities.iteritems():
-            field_timeline = timeline[entity_field]
+            cube = columns.get_entity_year_cube(reader, entity_field, cluster_field)
+            timeline[entity_field] = {}
+            if deadline is not None and time.time() > deadline:
+                # Leave out the remaining entities
+                result['partial'] = True
+                continue
+            # The timelines of all the field's entities are found together, so
+            # that they can share one pass over each partition of the matches
+            value_index = cube.entity_column.value_index
+            known_values = [v for v in entity_values if v in value_index]
+            keys = dict(zip(known_values, self.partition_pool.timeline_keys(cube, [value_index[v] for v in known_values], matches.mask)))
             for entity_value in entity_values:
-                field_timeline[entity_value] = dict((y, list(cvs)) for y, cvs in field_timeline[entity_value].iteritems())
+                timeline[entity_field][entity_value] = cube.timeline(entity_value, matches.mask, keys.get(entity_value))
 
         result['timeline'] = timeline
         return result
 
-    def handle_independent_view(self, view, whoosh_query):
+    def handle_independent_view(self, view, matches):
         """
-        Handles one of the views which is done on its own independent Whoosh
-        query.
+        Handles one of the views which is not done as a field count.
         """
 
         type = view['type']
         if type == 'descriptions':
-            return self._handle_descriptions_view(view, whoosh_query)
+            return self._handle_descriptions_view(view, matches)
+        elif type == 'countbyyear':
+            return self._handle_countbyyear_view(view, matches)
+        elif type == 'countbyreferencepoint':
+            return self._handle_countbyreferencepoint_view(view, matches)
         elif type == 'referencepointlinks':
-            return self._handle_referencepointlinks_view(view, whoosh_query)
+            return self._handle_referencepointlinks_view(view, matches)
         elif type == 'tsnecoordinates':
-            return self._handle_tsnecoordinates_view(view, whoosh_query)
+            return self._handle_tsnecoordinates_view(view, matches)
+        elif type == 'tsnetext':
+            return self._handle_tsnetext_view(view, matches)
         elif type == 'plottimeline':
-            return self._handle_plottimeline_view(view, whoosh_query)
+            return self._handle_plottimeline_view(view, matches)
+        elif type == 'suggestions':
+            return self._handle_suggestions_view(view, matches)
         else:
             raise ValueError("unknown view type \"%s\"" % (type))
 
-    def generate_views(self, response, views, whoosh_query):
+    def generate_views(self, response, views, matches):
         """
         Produces the JSON (as python objects) response for the view requests.
         response: Response JSON (as python objects) to put output in.
         views: The views as dictionary of JSON (as python objects) views, keyed
                by their IDs.
-        whoosh_query: The Whoosh query object for the current query.
+        matches: The documents matching the constraints of the current query.
         """
 
         # We defer all the count by field value views until the end so we can do
-        # them all on a single Whoosh query. We also rewrite some other queries
+        # them all together on the column store. We also rewrite some other queries
         # in terms of field value views (these get separate query types since
         # they might need special handling later).
         field_count_views = {}
 
         for view_id, view in views.iteritems():
             type = view['type']
-            if type == 'countbyfieldvalue':
+            too_expensive = self._too_expensive_result(view, matches)
+            if too_expensive is not None:
+                response[view_id] = too_expensive
+            elif type == 'countbyfieldvalue':
                 field_count_views[view_id] = view
-            elif type == 'countbyreferencepoint':
+            elif type == 'countbyreferencepoint' and 'zoom' not in view and 'bounds' not in view:
                 field_count_views[view_id] = {
                     'type': 'countbyfieldvalue',
-                    'field': 'referencePoints'
-                }
-            elif type == 'countbyyear':
-                field_count_views[view_id] = {
-                    'type': 'countbyfieldvalue',
-                    'field': 'year'
+                    'field': 'referencePoints',
+                    'allvalues': True
                 }
             else:
                 try:
-                    response[view_id] = self.handle_independent_view(view, whoosh_query)
+                    response[view_id] = self.handle_independent_view(view, matches)
                 except Exception, e:
                     response[view_id] = {'error': e.value if isinstance(e, QueryHandlingError) else True}
                     logger.exception(self.tracking_code + " error while generating a view:")
 
         if len(field_count_views) > 0:
             try:
-                self.generate_field_counts(response, field_count_views, whoosh_query)
+                self.generate_field_counts(response, field_count_views, matches)
             except Exception, e:
                 message = e.value if isinstance(e, QueryHandlingError) else True
                 for view_id in field_count_views:
@@ -370,13 +987,60 @@ class Querier:
 
         return response
 
-    def handle_all_views(self, query, whoosh_query):
-        # This is inefficient but works to generate cache keys. For each view we
-        # will use an SHA keys across the stringified JSON for all the
-        # constraints and that view.
-        constraints_hash = hashlib.sha1()
-        for constraint in query['constraints'].iteritems():
-            constraints_hash.update(json.dumps(constraint))
+    def generate_admitted_views(self, response, views, matches):
+        """
+        Produces the response for view requests as generate_views() does, once
+        the process's admission control (if any) admits their estimated cost.
+        If they are not admitted in time, each view gets a server busy error
+        instead.
+        """
+        if self.admission is None or matches.unconstrained or len(views) == 0:
+            return self.compute_views(response, views, matches)
+        num_matches = matches.estimated_count()
+        max_view_cost = self.max_view_cost if self.max_view_cost is not None else float('inf')
+        cost = sum(min(self.view_cost(v, num_matches), max_view_cost) for v in views.itervalues())
+        if not self.admission.admit(cost):
+            logger.warn(self.tracking_code + " not admitting views with estimated cost %i" % (cost))
+            for view_id in views:
+                response[view_id] = {'error': "server busy; try again later", 'busy': True}
+            return response
+        try:
+            return self.compute_views(response, views, matches)
+        finally:
+            self.admission.release(cost)
+
+    def compute_views(self, response, views, matches):
+        """
+        Produces the response for view requests as generate_views() does, in a
+        worker process of the executor if there is one.
+        """
+        if self.executor is not None and len(views) > 0:
+            result = self.executor.run('handle_views_in_worker', {'constraints': matches.constraints, 'views': views}, matches.columns.identity)
+            if result is not None:
+                response.update(result)
+                return response
+        return self.generate_views(response, views, matches)
+
+    def handle_views_in_worker(self, query):
+        """
+        Produces the response for the views of a query without caching or
+        paginating it, for the querier of an executor worker process (see
+        compute_views()). The views are already stripped of page numbers and
+        required keys by the querier that sent them.
+        """
+        with self.searcher() as searcher:
+            return self.generate_views({}, query['views'], self.handle_all_constraints(query, searcher))
+
+    def estimate_views_in_worker(self, query):
+        """
+        Estimates the results of the views of a query as estimate_views()
+        does, for the querier of an executor worker process.
+        """
+        with self.searcher() as searcher:
+            return self.estimate_views(query, self.handle_all_constraints(query, searcher))
+
+    def handle_all_views(self, query, matches):
+        constraints_hash = self.constraints_cache_hash(query)
 
         response = {}
         needed_views = {}
@@ -412,9 +1076,7 @@ class Querier:
                     else:
                         required_keys = []
 
-                h = constraints_hash.copy()
-                h.update(json.dumps(view))
-                cache_key = h.hexdigest()
+                cache_key = self.view_cache_key(constraints_hash, view)
                 views_cache_key[view_id] = cache_key
 
                 # If caching the whole result, then use the cached copy if
@@ -446,21 +1108,56 @@ class Querier:
 
             logger.debug(self.tracking_code + " handling view \"%s\" of type \"%s\": %s" % (view_id, view['type'], method_str))
 
-        # Get results for all views that were not cached.
-        self.generate_views(response, needed_views, whoosh_query)
+        def cache_results(view_ids):
+            # A query still running on an older version of the index after
+            # the cache has moved on to a newer one must not cache its results
+            # as the newer version's
+            if getattr(self.cache, 'index_identity', None) not in [None, matches.columns.identity]:
+                logger.warn(self.tracking_code + " not caching results for an old index generation")
+                return
+            for view_id in view_ids:
+                if view_id in views_cache_key:
+                    if 'error' in response[view_id]:
+                        logger.error(self.tracking_code + " not caching due to error")
+                    elif response[view_id].get('partial', False):
+                        logger.warn(self.tracking_code + " not caching partial result")
+                    else:
+                        self.cache.set(views_cache_key[view_id], response[view_id], timeout=self.cache_timeout(query, query['views'][view_id]))
+
+        # Get results for all views that were not cached. If another request is
+        # already computing a cacheable result, then wait for that result rather
+        # than computing it again.
+        waiting_views = {}
+        flight_keys = []
+        if self.flights is not None:
+            for view_id in needed_views.keys():
+                if view_id in views_cache_key:
+                    flight_key = self.flights.begin(views_cache_key[view_id])
+                    if flight_key is not None:
+                        flight_keys.append(flight_key)
+                    else:
+                        waiting_views[view_id] = needed_views.pop(view_id)
+        try:
+            self.generate_admitted_views(response, needed_views, matches)
+            cache_results(needed_views)
+        finally:
+            for flight_key in flight_keys:
+                self.flights.end(flight_key)
+
+        for view_id in waiting_views.keys():
+            view_response = self.flights.wait(views_cache_key[view_id])
+            if view_response is not None:
+                logger.debug(self.tracking_code + " handling view \"%s\": using result of concurrent request" % (view_id))
+                response[view_id] = view_response
+                del waiting_views[view_id]
+        if len(waiting_views) > 0:
+            self.generate_admitted_views(response, waiting_views, matches)
+            cache_results(waiting_views)
 
         for view_id, view in query['views'].iteritems():
             if view_id in views_cache_key:
                 result = response[view_id]
                 how_to_paginate_result = views_how_to_paginate_result.get(view_id)
-                # Update the caches.
-                if view_id in views_should_cache:
-                    if 'error' in result:
-                        logger.error(self.tracking_code + " not caching due to error")
-                    else:
-                        self.cache.set(views_cache_key[view_id], result)
-                elif how_to_paginate_result is not None:
-                    self.cache.set(views_cache_key[view_id], result)
                 # Handle result pagination.
                 if how_to_paginate_result is not None:
                     paginate_attr, page_size = how_to_paginate_result
@@ -481,6 +1178,13 @@ class Querier:
                                     need_to_prepend.append(pair)
                                 elif k >= j:
                                     need_to_append.append(pair)
+                        if 'numValues' in result:
+                            # Required keys may be among the values left out
+                            # of a count by field value result
+                            found_keys = set(key for key, value in need_to_prepend + need_to_append + paginated_result[paginate_attr])
+                            missing_keys = [key for key in views_required_keys[view_id] if key not in found_keys]
+                            if len(missing_keys) > 0:
+                                need_to_append += self._count_field_values(view, matches, missing_keys)
                         paginated_result[paginate_attr] = need_to_prepend + paginated_result[paginate_attr] + need_to_append
                         paginated_result['more'] = j < len(result[paginate_attr])
                         response[view_id] = paginated_result
@@ -494,7 +1198,113 @@ class Querier:
         for query in self.queries_to_prime():
             self.handle(query)
 
-    # TODO: pagination, caching, etc. for new plottimeline view
+    def _estimate_view(self, view, matches, sample):
+        """
+        Estimates the result of a view from a sample of the matching documents.
+        Counts are replaced by estimates, with the margins of their confidence
+        intervals alongside. Returns None for views that are not estimated.
+        """
+        type = view['type']
+        page_num = int(view.get('page', 0))
+        if type == 'countbyfieldvalue':
+            field = domain_config.field_name_aliases(view['field']) or view['field']
+            column = matches.columns.get_keyword_columns(matches.reader, [field])[field]
+            keys, counts, margins = sample.estimate_counts(column.count_docs)
+            keys = [column.values[k] for k in keys.tolist()]
+            page_size = self.count_by_field_value_page_size
+        elif type in ['countbyreferencepoint', 'referencepointlinks']:
+            refpoint_matrix, within = self._refpoint_view_matrix(view, matches)
+            if type == 'countbyreferencepoint':
+                keys, counts, margins = sample.estimate_counts(refpoint_matrix.count_docs)
+                if within is not None:
+                    keep = within[keys]
+                    keys, counts, margins = keys[keep], counts[keep], margins[keep]
+                keys = [refpoint_matrix.refpoints[k] for k in keys.tolist()]
+                page_size = self.count_by_referencepoint_page_size if 'page' in view else None
+            else:
+                keys, counts, margins = sample.estimate_counts(refpoint_matrix.link_count_docs)
+                if within is not None:
+                    num_refpoints = len(refpoint_matrix.refpoints)
+                    keep = within[keys // num_refpoints] | within[keys % num_refpoints]
+                    keys, counts, margins = keys[keep], counts[keep], margins[keep]
+                # In row and then column order of the link matrix, as the
+                # exact result is (see IncidenceMatrix.link_counts()), so that
+                # estimated pages have the same links as the exact ones
+                order = numpy.argsort(keys, kind='mergesort')
+                keys, counts, margins = keys[order], counts[order], margins[order]
+                keys = [refpoint_matrix.link_refpoints(k) for k in keys.tolist()]
+                page_size = self.referencepointlinks_page_size if 'page' in view else None
+        else:
+            return None
+
+        counts, margins = counts.tolist(), margins.tolist()
+        if page_size is not None:
+            i, j = page_num * page_size, (page_num + 1) * page_size
+            required_keys = set(view.get('requiredkeys', []))
+            in_page = [k for k in range(len(keys)) if i <= k < j or keys[k] in required_keys]
+            more = j < len(keys)
+            keys, counts, margins = [keys[k] for k in in_page], [counts[k] for k in in_page], [margins[k] for k in in_page]
+        if type == 'referencepointlinks':
+            result = {'links': [{'refpoints': p, 'count': c, 'margin': m} for p, c, m in zip(keys, counts, margins)]}
+        else:
+            result = {'counts': zip(keys, counts), 'margins': margins}
+        if page_size is not None:
+            result['more'] = more
+        result['estimate'] = sample.summary()
+        return result
+
+    def estimate_views(self, query, matches):
+        """
+        Estimates the results of the count views of a query from a stratified
+        random sample of the matching documents, if there are enough matches
+        for counting them all to be slow. Unconstrained results are not
+        estimated since they come from the primed cache. Returns a response
+        with only the estimated views.
+        """
+        response = {}
+        if matches.unconstrained:
+            return response
+        docnums = matches.docnums()
+        if len(docnums) < self.progressive_min_matches:
+            return response
+        sample = estimates.StratifiedSample(docnums, self.progressive_sample_size, self.progressive_num_strata)
+        for view_id, view in query['views'].iteritems():
+            try:
+                result = self._estimate_view(view, matches, sample)
+                if result is not None:
+                    response[view_id] = result
+            except Exception:
+                # Left for the exact result to report
+                logger.exception(self.tracking_code + " error while estimating a view:")
+        logger.info(self.tracking_code + " estimated %i views from %i of %i matching documents" % (len(response), sample.num_sampled, len(docnums)))
+        return response
+
+    # TODO: pagination for plottimeline view
+
+    def searcher(self):
+        """
+        Gets a context manager for the searcher to handle a query with: one
+        from the searcher pool if there is one, and otherwise a new one.
+        """
+        if self.searchers is not None:
+            return self.searchers.searcher()
+        return self.whoosh_index.searcher()
+
+    def _error_response(self, query, e):
+        """
+        Makes the response for a query that failed as a whole, with the error
+        for every view.
+        """
+        message = e.value if isinstance(e, QueryHandlingError) else True
+        response = {}
+        if 'variants' in query:
+            for variant_id, variant in query['variants'].iteritems():
+                response[variant_id] = dict((view_id, {'error': message}) for view_id in variant['views'])
+        else:
+            for view_id in query['views']:
+                response[view_id] = {'error': message}
+        logger.exception(self.tracking_code + " error while handling query:")
+        return response
 
     def handle(self, query):
         """
@@ -504,17 +1314,50 @@ class Querier:
         """
         start_time = time.time()
         try:
-            whoosh_query = self.handle_all_constraints(query)
-            if self.verbose:
-                logger.debug(self.tracking_code + " whoosh query: %s" % (repr(whoosh_query)))
-            response = self.handle_all_views(query, whoosh_query)
+            with self.searcher() as searcher:
+                if 'variants' in query:
+                    response = self.handle_all_variants(query, searcher)
+                else:
+                    matches = self.handle_all_constraints(query, searcher)
+                    response = self.handle_all_views(query, matches)
         except Exception, e:
-            message = e.value if isinstance(e, QueryHandlingError) else True
-            response = {}
-            for view_id in query['views']:
-                response[view_id] = {'error': message}
-            logger.exception(self.tracking_code + " error while handling query:")
+            response = self._error_response(query, e)
         if self.verbose:
             done_time = time.time()
             logger.debug(self.tracking_code + " query handling time: %0.4f" % (done_time - start_time))
         return response
+
+    def handle_progressive(self, query):
+        """
+        Produces the response for a query in stages, as a generator of JSON
+        (as python objects) responses: first a response with estimates for the
+        count views (see estimate_views()), if any were estimated, and then
+        the full response as from handle(). The constraints are only evaluated
+        once for both, and views with cached results are not estimated.
+        query: The query as JSON (as python objects).
+        """
+        if 'variants' in query:
+            yield self.handle(query)
+            return
+        start_time = time.time()
+        try:
+            with self.searcher() as searcher:
+                matches = self.handle_all_constraints(query, searcher)
+                cached_view_ids = self.cached_view_ids(query)
+                estimate_query = dict(query, views=dict((view_id, view) for view_id, view in query['views'].iteritems() if view_id not in cached_view_ids))
+                estimated = None
+                if self.executor is not None:
+                    estimated = self.executor.run('estimate_views_in_worker', estimate_query, matches.columns.identity)
+                if estimated is None:
+                    estimated = self.estimate_views(estimate_query, matches)
+                if len(estimated) > 0:
+                    if self.verbose:
+                        logger.debug(self.tracking_code + " query estimating time: %0.4f" % (time.time() - start_time))
+                    yield estimated
+                response = self.handle_all_views(query, matches)
+        except Exception, e:
+            response = self._error_response(query, e)
+        if self.verbose:
+            done_time = time.time()
+            logger.debug(self.tracking_code + " query handling time: %0.4f" % (done_time - start_time))
+        yield response
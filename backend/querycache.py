@@ -0,0 +1,229 @@
+"""
+Caching for query results.
+"""
+
+import collections
+import os
+import time
+import cPickle as pickle
+
+from werkzeug.contrib.cache import BaseCache
+
+# Use gevent events and sleeping if available, since the backend normally runs
+# in gevent greenlets under uWSGI.
+try:
+    import gevent
+    import gevent.event
+    _Event = gevent.event.Event
+    _sleep = gevent.sleep
+except ImportError:
+    import threading
+    _Event = threading.Event
+    _sleep = time.sleep
+
+class TieredCache(BaseCache):
+    """
+    Two tier cache: a process-local least recently used cache bounded by the
+    total pickled size of its values, in front of a shared cache (normally a
+    RedisCache shared by all backend processes). Values found only in the
+    shared cache are copied into the local one.
+
+    All keys are namespaced by the index identity set with
+    set_index_identity() (see whooshutils.reader_index_identity(), which
+    unlike the generation number also changes when the index is rebuilt), so
+    that results for an old index are never used once the index changes; the
+    local tier is also emptied at that point. The shared tier keeps any
+    old entries until they time out or the shared cache is cleared.
+
+    Values from the local tier are returned without copying, so callers must
+    not modify cached values.
+    """
+
+    def __init__(self, shared_cache, max_local_bytes, default_timeout=0):
+        BaseCache.__init__(self, default_timeout=default_timeout)
+        self.shared_cache = shared_cache
+        self.max_local_bytes = max_local_bytes
+        self.index_identity = None
+        self.local_entries = collections.OrderedDict()
+        self.local_bytes = 0
+        self.counters = {
+            'local': {'hits': 0, 'misses': 0, 'evictions': 0},
+            'shared': {'hits': 0, 'misses': 0}
+        }
+
+    def set_index_identity(self, index_identity):
+        """
+        Sets the index identity to namespace keys by, clearing the local tier
+        if it changed.
+        """
+        if index_identity != self.index_identity:
+            self.index_identity = index_identity
+            self.clear_local()
+
+    def clear_local(self):
+        self.local_entries.clear()
+        self.local_bytes = 0
+
+    def _key(self, key):
+        return "%s:%s" % (self.index_identity, key)
+
+    def _set_local(self, key, value, size):
+        if key in self.local_entries:
+            self.local_bytes -= self.local_entries.pop(key)[1]
+        if size > self.max_local_bytes:
+            return
+        self.local_entries[key] = (value, size)
+        self.local_bytes += size
+        while self.local_bytes > self.max_local_bytes:
+            old_key, (old_value, old_size) = self.local_entries.popitem(last=False)
+            self.local_bytes -= old_size
+            self.counters['local']['evictions'] += 1
+
+    def get(self, key):
+        key = self._key(key)
+        entry = self.local_entries.pop(key, None)
+        if entry is not None:
+            self.local_entries[key] = entry
+            self.counters['local']['hits'] += 1
+            return entry[0]
+        self.counters['local']['misses'] += 1
+
+        value = self.shared_cache.get(key)
+        if value is None:
+            self.counters['shared']['misses'] += 1
+            return None
+        self.counters['shared']['hits'] += 1
+        self._set_local(key, value, len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        return value
+
+    def set(self, key, value, timeout=None):
+        key = self._key(key)
+        self._set_local(key, value, len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        return self.shared_cache.set(key, value, timeout=self._normalize_timeout(timeout))
+
+    def add(self, key, value, timeout=None):
+        if not self.shared_cache.add(self._key(key), value, timeout=self._normalize_timeout(timeout)):
+            return False
+        self._set_local(self._key(key), value, len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        return True
+
+    def delete(self, key):
+        key = self._key(key)
+        if key in self.local_entries:
+            self.local_bytes -= self.local_entries.pop(key)[1]
+        return self.shared_cache.delete(key)
+
+    def has(self, key):
+        return self._key(key) in self.local_entries or self.shared_cache.has(self._key(key))
+
+    def clear(self):
+        self.clear_local()
+        return self.shared_cache.clear()
+
+    def _normalize_timeout(self, timeout):
+        return self.default_timeout if timeout is None else timeout
+
+    def stats(self):
+        """
+        Gets the counters for both tiers, along with the current size of the
+        local tier.
+        """
+        stats = dict((tier, dict(counters)) for tier, counters in self.counters.iteritems())
+        stats['local']['entries'] = len(self.local_entries)
+        stats['local']['bytes'] = self.local_bytes
+        return stats
+
+# Redis script deleting a lock only if it still has our token
+_release_lock_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+else
+    return 0
+end
+"""
+
+class SingleFlight:
+    """
+    Coalesces concurrent computations of the same cached result. When several
+    requests miss on the same key, only the first computes the result and the
+    others wait for it to appear in the cache.
+
+    Within a process this uses events. Across processes it uses a Redis lock
+    per key with a short lease, so a failed or stuck computation only holds up
+    the others until the lease runs out. Without a Redis client only requests
+    in the same process are coalesced.
+
+    Computations are namespaced by the index identity of the cache, if it has
+    one (see TieredCache), as the cache's keys are, so that while the index
+    changes nobody waits for a computation for another version of the index.
+    """
+
+    def __init__(self, cache, redis_client=None, lease=10.0, wait_timeout=30.0,
+                 poll_interval=0.05, lock_prefix="query_lock:"):
+        self.cache = cache
+        self.redis_client = redis_client
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.lock_prefix = lock_prefix
+        self.token = "%i-%s" % (os.getpid(), os.urandom(8).encode('hex'))
+        self.in_flight = {}
+        self.counters = {'computed': 0, 'coalesced': 0, 'timeouts': 0}
+
+    def _flight_key(self, key):
+        return "%s:%s" % (getattr(self.cache, 'index_identity', None), key)
+
+    def begin(self, key):
+        """
+        Tries to become the computer of the result for a key. If so, returns
+        the key of the computation, to give to end() once the result is cached
+        (or has failed). Returns None if someone else is already computing it.
+        """
+        flight_key = self._flight_key(key)
+        if flight_key in self.in_flight:
+            return None
+        if self.redis_client is not None:
+            if not self.redis_client.set(self.lock_prefix + flight_key, self.token, nx=True, px=int(self.lease * 1000)):
+                return None
+        self.in_flight[flight_key] = _Event()
+        self.counters['computed'] += 1
+        return flight_key
+
+    def end(self, flight_key):
+        """
+        Finishes a computation started with begin(), by the key it returned
+        (which stays the same if the index changes meanwhile), waking any
+        waiters.
+        """
+        event = self.in_flight.pop(flight_key, None)
+        if self.redis_client is not None:
+            self.redis_client.eval(_release_lock_script, 1, self.lock_prefix + flight_key, self.token)
+        if event is not None:
+            event.set()
+
+    def wait(self, key):
+        """
+        Waits for someone else's computation of a key to finish and gets the
+        result from the cache. Returns None if the result does not appear, for
+        example because the computation failed or took too long, in which case
+        the caller should compute it itself.
+        """
+        flight_key = self._flight_key(key)
+        event = self.in_flight.get(flight_key)
+        if event is not None:
+            if not event.wait(self.wait_timeout):
+                self.counters['timeouts'] += 1
+            value = self.cache.get(key)
+        else:
+            deadline = time.time() + self.wait_timeout
+            while True:
+                value = self.cache.get(key)
+                if value is not None or self.redis_client is None or not self.redis_client.exists(self.lock_prefix + flight_key):
+                    break
+                if time.time() >= deadline:
+                    self.counters['timeouts'] += 1
+                    break
+                _sleep(self.poll_interval)
+        if value is not None:
+            self.counters['coalesced'] += 1
+        return value
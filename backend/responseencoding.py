@@ -0,0 +1,136 @@
+"""
+Compact typed array encoding for query responses.
+
+The encoded response is a 4 byte little-endian unsigned length, a JSON header of
+that many bytes, and then a data section of packed little-endian arrays. The
+header is the normal JSON response except that the bulky numeric parts of some
+view results are moved into the data section:
+
+- "counts" lists of (value, count) pairs become
+  {"typed": "pairs", "keys": [values...], "counts": ARRAY}
+- "links" lists become
+  {"typed": "links", "refpoints": [flat list of refpoint pairs], "counts": ARRAY}
+- "coordinates" lists (tsnecoordinates) become
+  {"typed": "coordinates", "ids": ARRAY, "x": ARRAY, "y": ARRAY, "text": [texts...]}
+
+where each ARRAY is {"type": "int32" or "float32", "offset": byte offset into
+the data section, "length": number of elements}. The header is padded with
+spaces so that the data section starts on a 4 byte boundary. Decoding rebuilds
+the normal JSON response, except that coordinates become numbers.
+
+The response to a query with variants has the view results one level down,
+keyed by variant ID and then by view ID, and is encoded and decoded as such
+when asked to.
+"""
+
+import struct
+import numpy
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Mimetype for the encoding, usable in the Accept header
+mimetype = 'application/x-lensing-typed'
+# Value of the format query string argument asking for the encoding
+format_name = 'typed'
+
+class _DataSection:
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def add(self, values, type):
+        data = numpy.asarray(values, dtype='<i4' if type == 'int32' else '<f4').tostring()
+        ref = {'type': type, 'offset': self.size, 'length': len(values)}
+        self.parts.append(data)
+        self.size += len(data)
+        return ref
+
+def _encode_view_result(result, data):
+    if not isinstance(result, dict) or 'error' in result:
+        return result
+    encoded = dict(result)
+    if isinstance(result.get('counts'), list):
+        counts = result['counts']
+        encoded['counts'] = {
+            'typed': 'pairs',
+            'keys': [k for k, c in counts],
+            'counts': data.add([c for k, c in counts], 'int32')
+        }
+    if isinstance(result.get('links'), list):
+        links = result['links']
+        encoded['links'] = {
+            'typed': 'links',
+            'refpoints': [p for l in links for p in l['refpoints']],
+            'counts': data.add([l['count'] for l in links], 'int32')
+        }
+    if isinstance(result.get('coordinates'), list):
+        coordinates = result['coordinates']
+        encoded['coordinates'] = {
+            'typed': 'coordinates',
+            'ids': data.add([c['id'] for c in coordinates], 'int32'),
+            'x': data.add([float(c['coordinates']['x']) for c in coordinates], 'float32'),
+            'y': data.add([float(c['coordinates']['y']) for c in coordinates], 'float32'),
+            'text': [c['text'] for c in coordinates]
+        }
+    return encoded
+
+def _encode_views(response, data, variants):
+    if variants:
+        return dict((variant_id, _encode_views(r, data, False)) for variant_id, r in response.iteritems())
+    return dict((view_id, _encode_view_result(r, data)) for view_id, r in response.iteritems())
+
+def encode(response, variants=False):
+    """
+    Encodes a query response (a dictionary of view results keyed by view ID,
+    or with variants a dictionary of those keyed by variant ID) as a byte
+    string.
+    """
+    data = _DataSection()
+    header = json.dumps(_encode_views(response, data, variants))
+    if isinstance(header, unicode):
+        header = header.encode('utf-8')
+    header += ' ' * (-(len(header) + 4) % 4)
+    return struct.pack('<I', len(header)) + header + ''.join(data.parts)
+
+def _decode_array(data, ref):
+    return numpy.frombuffer(data, dtype='<i4' if ref['type'] == 'int32' else '<f4', count=ref['length'], offset=ref['offset']).tolist()
+
+def _decode_view_result(result, data):
+    if not isinstance(result, dict):
+        return result
+    result = dict(result)
+    typed = dict((k, v) for k, v in result.iteritems() if isinstance(v, dict) and 'typed' in v)
+    for key, value in typed.iteritems():
+        if value['typed'] == 'pairs':
+            result[key] = [[k, c] for k, c in zip(value['keys'], _decode_array(data, value['counts']))]
+        elif value['typed'] == 'links':
+            refpoints = value['refpoints']
+            result[key] = [{'refpoints': refpoints[2*i:2*i+2], 'count': c} for i, c in enumerate(_decode_array(data, value['counts']))]
+        elif value['typed'] == 'coordinates':
+            ids, xs, ys = (_decode_array(data, value[k]) for k in ['ids', 'x', 'y'])
+            result[key] = [{'id': i, 'coordinates': {'x': x, 'y': y}, 'text': t} for i, x, y, t in zip(ids, xs, ys, value['text'])]
+    return result
+
+def _decode_views(header, data, variants):
+    if variants:
+        return dict((variant_id, _decode_views(r, data, False)) for variant_id, r in header.iteritems())
+    return dict((view_id, _decode_view_result(r, data)) for view_id, r in header.iteritems())
+
+def decode(encoded, variants=False):
+    """
+    Decodes a byte string made by encode() back to a query response. Variants
+    must be given as for encoding.
+    """
+    header_length, = struct.unpack('<I', encoded[:4])
+    header = json.loads(encoded[4:4 + header_length])
+    return _decode_views(header, encoded[4 + header_length:], variants)
+
+def wants_encoding(args, headers):
+    """
+    Checks if a request asked for the encoding, either with the format query
+    string argument or the Accept header.
+    """
+    return args.get('format') == format_name or mimetype in headers.get('Accept', '')
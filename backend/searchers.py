@@ -0,0 +1,86 @@
+"""
+Long-lived index searchers shared by the queries of a backend process.
+"""
+
+import contextlib
+import logging
+import time
+import whooshutils
+
+logger = logging.getLogger("query-logger")
+
+class SearcherPool:
+    """
+    Keeps a searcher open for the latest generation of an index, so that
+    queries do not each open the index. The index directory is checked for a
+    newer generation at most every check_interval seconds, by its identity
+    rather than its generation number, so that an index rebuilt from scratch
+    and put in place of the old one is seen as new even though it has the
+    same generation number. When one appears,
+    new queries switch to a searcher for it at once, while queries already
+    running finish on the searcher they started with; that searcher is closed
+    when the last of them is done. This lets a new generation of the index be
+    rolled out without restarting the backend.
+
+    Whoosh's Searcher.refresh() is not used, since it shares segment readers
+    with the old searcher and closes them while queries may still be using
+    them.
+    """
+
+    def __init__(self, whoosh_index, check_interval=1.0):
+        self.whoosh_index = whoosh_index
+        self.check_interval = check_interval
+        self.current = whoosh_index.searcher()
+        self.current_identity = whooshutils.reader_index_identity(self.current.reader())
+        self.last_check = time.time()
+        # Number of running queries using each open searcher
+        self.num_users = {self.current: 0}
+        self.counters = {'swaps': 0, 'closed': 0}
+
+    def identity(self):
+        """
+        Gets the index identity (see whooshutils.reader_index_identity()) of
+        the current searcher.
+        """
+        return self.current_identity
+
+    def refresh(self, force=False):
+        """
+        Switches to a searcher for the latest generation of the index if there
+        is a newer one, checking at most every check_interval seconds unless
+        forced to check now. Returns the current index identity.
+        """
+        now = time.time()
+        if force or now - self.last_check >= self.check_interval:
+            self.last_check = now
+            if whooshutils.latest_index_identity(self.whoosh_index) != self.current_identity:
+                old, old_identity = self.current, self.current_identity
+                self.current = self.whoosh_index.searcher()
+                self.current_identity = whooshutils.reader_index_identity(self.current.reader())
+                self.num_users[self.current] = 0
+                self.counters['swaps'] += 1
+                logger.info("switched from index %s to %s" % (old_identity, self.current_identity))
+                self._close_if_unused(old)
+        return self.identity()
+
+    def _close_if_unused(self, searcher):
+        if searcher is not self.current and self.num_users[searcher] == 0:
+            del self.num_users[searcher]
+            searcher.close()
+            self.counters['closed'] += 1
+
+    @contextlib.contextmanager
+    def searcher(self):
+        """
+        Context manager giving the current searcher for the length of a query.
+        The searcher stays open, and is not switched for the query, until the
+        context exits.
+        """
+        self.refresh()
+        searcher = self.current
+        self.num_users[searcher] += 1
+        try:
+            yield searcher
+        finally:
+            self.num_users[searcher] -= 1
+            self._close_if_unused(searcher)
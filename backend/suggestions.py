@@ -0,0 +1,125 @@
+"""
+Prefix and fuzzy completion of facet values and text search terms.
+"""
+
+import bisect
+import collections
+import numpy
+
+from whoosh.automata.fsa import ANY
+from whoosh.automata.lev import levenshtein_automaton
+
+class Lexicon:
+    """
+    Sorted lexicon of values with their document frequencies, for completing
+    typed text. Values are looked up by a lowercased key, so that completion is
+    case-insensitive, and the keys are kept sorted so that the values starting
+    with a prefix are a contiguous range found by binary search.
+    """
+
+    def __init__(self, values, frequencies):
+        keys = [v.lower() for v in values]
+        order = sorted(range(len(values)), key=lambda i: keys[i])
+        self.keys = [keys[i] for i in order]
+        self.values = [values[i] for i in order]
+        self.frequencies = numpy.array([frequencies[i] for i in order], dtype=numpy.int64)
+
+    def _top(self, positions, limit):
+        """
+        Gets up to limit of the given positions with the highest frequencies,
+        in decreasing order of frequency and then in key order.
+        """
+        frequencies = self.frequencies[positions]
+        if len(positions) > limit:
+            # Keep everything at least as frequent as the limit'th value, so
+            # that ties are still broken by key order
+            threshold = -numpy.partition(-frequencies, limit - 1)[limit - 1]
+            kept = frequencies >= threshold
+            positions, frequencies = positions[kept], frequencies[kept]
+        return positions[numpy.argsort(-frequencies, kind='mergesort')[:limit]]
+
+    def complete(self, prefix, limit):
+        """
+        Gets the positions of up to limit of the most frequent values starting
+        with a prefix.
+        """
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + u'\uffff', start)
+        return self._top(numpy.arange(start, end), limit)
+
+    def fuzzy_complete(self, prefix, max_edits, limit, max_candidates):
+        """
+        Gets the positions of up to limit of the most frequent values starting
+        with a string within an edit distance of a prefix. Candidates are found
+        by walking a Levenshtein automaton for the prefix (extended to accept
+        anything after it) over the sorted keys, and only the first
+        max_candidates are considered.
+        """
+        nfa = levenshtein_automaton(prefix.lower(), max_edits)
+        for state in list(nfa.final_states):
+            nfa.add_transition(state, ANY, state)
+        dfa = nfa.to_dfa()
+
+        positions = []
+        match = dfa.next_valid_string(u'')
+        while match is not None and len(positions) < max_candidates:
+            i = bisect.bisect_left(self.keys, match)
+            if i == len(self.keys):
+                break
+            key = self.keys[i]
+            if dfa.accept(key):
+                positions.append(i)
+                match = dfa.next_valid_string(key + u'\0')
+            else:
+                match = dfa.next_valid_string(key)
+        return self._top(numpy.array(positions, dtype=numpy.int64), limit)
+
+    def suggest(self, prefix, limit, max_edits=0, max_candidates=0):
+        """
+        Gets suggestions for a prefix as a list of (value, document frequency)
+        pairs: first the most frequent values starting with the prefix, and
+        then, if max_edits is non-zero, the most frequent values starting with
+        something within that edit distance of the prefix.
+        """
+        positions = self.complete(prefix, limit).tolist()
+        if max_edits > 0 and len(positions) < limit:
+            seen = set(positions)
+            for i in self.fuzzy_complete(prefix, max_edits, limit, max_candidates).tolist():
+                if i not in seen and len(positions) < limit:
+                    positions.append(i)
+        return [(self.values[i], int(self.frequencies[i])) for i in positions]
+
+def lexicon_from_column(column, live_mask):
+    """
+    Makes a lexicon of the values of a keyword column, with frequencies counted
+    over the live documents.
+    """
+    counts = column.count(live_mask)
+    present = numpy.flatnonzero(counts)
+    return Lexicon([unicode(column.values[i]) for i in present], counts[present].tolist())
+
+def lexicon_from_terms(reader, field_name, live_mask):
+    """
+    Makes a lexicon of the indexed terms of a field, with frequencies counted
+    over the live documents. The document frequencies from the index also
+    count deleted documents (and every document updated in place leaves a
+    deleted copy behind), so they are only used for segments without
+    deletions. Segments with no live documents left are skipped, and the
+    postings of each term in the other segments are counted against the live
+    mask. Terms found only in deleted documents are left out.
+    """
+    frequencies = collections.defaultdict(int)
+    for segment_reader, offset in reader.leaf_readers():
+        if segment_reader.doc_count() == 0:
+            continue
+        for term, info in segment_reader.iter_field(field_name):
+            if segment_reader.has_deletions():
+                docnums = numpy.fromiter(segment_reader.postings(field_name, term).all_ids(), dtype=numpy.int64)
+                frequency = int(numpy.count_nonzero(live_mask[offset + docnums]))
+            else:
+                frequency = info.doc_frequency()
+            if frequency > 0:
+                frequencies[term] += frequency
+    values = [term.decode('utf-8') if isinstance(term, str) else term for term in frequencies]
+    return Lexicon(values, frequencies.values())
@@ -3,6 +3,9 @@ Shared things and consistency settings.
 """
 
 import re
+import os.path
+import json
+import hashlib
 import whoosh, whoosh.index, whoosh.query, whoosh.qparser
 
 # Message for a commit on a large change
@@ -17,6 +20,13 @@ keyword_field_free_text_suffix = "_freeText"
 # Field name for merged version of all text and keyword fields
 all_text_merge_field = "all%s"% (keyword_field_free_text_suffix)
 
+# Name of the file in an index directory listing the IDs of the events added,
+# changed and deleted by incremental builds not yet processed by every step
+delta_manifest_file_name = "delta-manifest.json"
+# Programs processing the events in the delta manifest, which each mark it
+# consumed when done
+delta_manifest_steps = ['cluster', 'tsne']
+
 # Setting for the 'commas' option when making a schema keyword field
 keyword_field_commas = True
 
@@ -55,10 +65,13 @@ class TextQueryParser(whoosh.qparser.QueryParser):
                     if new_node is node:
                         new_node = node.copy()
                     node.fieldname = mapped_field_name
-                if isinstance(self.schema[node.fieldname], whoosh.fields.KEYWORD) or isinstance(self.schema[node.fieldname], whoosh.fields.ID):
+                # Keyword fields are searched through their free text field,
+                # except those without one (the event key)
+                free_text_field_name = "%s%s" % (node.fieldname, keyword_field_free_text_suffix)
+                if (isinstance(self.schema[node.fieldname], whoosh.fields.KEYWORD) or isinstance(self.schema[node.fieldname], whoosh.fields.ID)) and free_text_field_name in self.schema:
                     if new_node is node:
                         new_node = node.copy()
-                    new_node.fieldname = "%s%s" % (node.fieldname, keyword_field_free_text_suffix)
+                    new_node.fieldname = free_text_field_name
             if hasattr(node, 'text'):
                 if new_node is node:
                     new_node = node.copy()
@@ -98,18 +111,83 @@ def update_all_in_place(index, writer, modify_doc, order_num_field, buffer_size=
     with writer.searcher() as searcher:
         # We use manual pagination by counting on the unique numeric field because
         # using whoosh's pagination causes some documents to be skipped if we modify
-        # documents during the search
+        # documents during the search. Pages may be empty where documents have
+        # been deleted, so go up to the largest value rather than stopping at
+        # the first empty page.
+        field = searcher.schema[order_num_field]
+        max_num = max([field.from_bytes(t) for t in field.sortable_terms(searcher.reader(), order_num_field)] or [-1])
         page_num = 0
-        while True:
+        while page_num * buffer_size <= max_num:
             page_start = page_num * buffer_size
             range_ = whoosh.query.NumericRange(order_num_field,
                                                page_start,
                                                page_start + buffer_size - 1)
             hits = searcher.search(range_, limit=None, sortedby=order_num_field)
-            if hits.is_empty():
-                break
             buf = [h.fields() for h in hits]
             for doc in buf:
                 modify_doc(doc)
                 writer.update_document(**doc)
             page_num += 1
+
+def update_in_place(index, writer, modify_doc, unique_field, values):
+    """
+    Updates only the documents with the given values of a unique field
+    in-place, otherwise like update_all_in_place(). Values with no document are
+    ignored.
+    """
+    with writer.searcher() as searcher:
+        buf = [searcher.document(**{unique_field: value}) for value in values]
+    for doc in buf:
+        if doc is not None:
+            modify_doc(doc)
+            writer.update_document(**doc)
+
+def read_delta_manifest(index_path):
+    """
+    Reads the manifest written by an incremental build into an index directory,
+    as a dictionary of lists of the IDs of the added, changed and deleted
+    events.
+    """
+    with open(os.path.join(index_path, delta_manifest_file_name)) as manifest_file:
+        return json.load(manifest_file)
+
+def write_delta_manifest(index_path, manifest):
+    """
+    Writes the manifest of an incremental build into an index directory.
+    """
+    with open(os.path.join(index_path, delta_manifest_file_name), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+def mark_delta_manifest_consumed(index_path, step_name):
+    """
+    Records in the manifest of an index directory that a step (one of
+    delta_manifest_steps) has processed its events. Once every step has, the
+    next incremental build starts a new manifest rather than adding to it.
+    """
+    manifest = read_delta_manifest(index_path)
+    manifest['consumed'] = sorted(set(manifest.get('consumed', [])) | set([step_name]))
+    write_delta_manifest(index_path, manifest)
+
+def is_delta_manifest_consumed(manifest):
+    return set(delta_manifest_steps) <= set(manifest.get('consumed', []))
+
+def _index_identity(generation, segment_ids):
+    return "%i-%s" % (generation, hashlib.sha1(",".join(sorted(segment_ids))).hexdigest()[:12])
+
+def reader_index_identity(reader):
+    """
+    Gets a string identifying the version of an index a reader is for. The
+    generation number alone does not do, since a rebuilt index goes through
+    the same generation numbers again, so the IDs of the segments (which are
+    random for each new segment) are included too.
+    """
+    segments = [leaf.segment() for leaf, offset in reader.leaf_readers()]
+    return _index_identity(reader.generation(), [s.segment_id() for s in segments if s is not None])
+
+def latest_index_identity(index):
+    """
+    Gets the identity (see reader_index_identity()) of the latest version of
+    an index, without opening a reader.
+    """
+    toc = whoosh.index.TOC.read(index.storage, index.indexname)
+    return _index_identity(toc.generation, [s.segment_id() for s in toc.segments])
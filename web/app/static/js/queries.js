@@ -61,6 +61,143 @@ function _removeViews(stringifiedViews) {
 	}
 }
 
+/*
+ * Decode UTF-8 bytes to a string.
+ */
+function _decodeUtf8(bytes) {
+	if (typeof TextDecoder != 'undefined')
+		return new TextDecoder('utf-8').decode(bytes);
+	var str = "";
+	for (var i = 0; i < bytes.length; i += 8192)
+		str += String.fromCharCode.apply(null, bytes.subarray(i, i + 8192));
+	return decodeURIComponent(escape(str));
+}
+
+/*
+ * Decode a response in the backend's compact typed array format (see
+ * responseencoding.py in the backend) back to the normal response structure.
+ * The arrays are read as views on the response buffer, which assumes a
+ * little-endian platform. The response to a query with variants has the view
+ * results of each variant keyed by variant ID, which must be given.
+ */
+function _decodeTypedResponse(buffer, variants) {
+	var headerLength = new DataView(buffer).getUint32(0, true);
+	var response = JSON.parse(_decodeUtf8(new Uint8Array(buffer, 4, headerLength)));
+	var dataStart = 4 + headerLength;
+	function array(ref) {
+		var ArrayType = ref.type == 'float32' ? Float32Array : Int32Array;
+		return new ArrayType(buffer, dataStart + ref.offset, ref.length);
+	}
+	function decodeViews(views) {
+		for (var viewId in views) {
+			var result = views[viewId];
+			for (var key in result) {
+				var value = result[key];
+				if (value == null || !value.hasOwnProperty('typed'))
+					continue;
+				if (value.typed == 'pairs') {
+					var counts = array(value.counts), pairs = new Array(counts.length);
+					for (var i = 0; i < counts.length; i++)
+						pairs[i] = [value.keys[i], counts[i]];
+					result[key] = pairs;
+				} else if (value.typed == 'links') {
+					var counts = array(value.counts), links = new Array(counts.length);
+					for (var i = 0; i < counts.length; i++)
+						links[i] = { refpoints: [value.refpoints[2 * i], value.refpoints[2 * i + 1]], count: counts[i] };
+					result[key] = links;
+				} else if (value.typed == 'coordinates') {
+					var ids = array(value.ids), xs = array(value.x), ys = array(value.y), coordinates = new Array(ids.length);
+					for (var i = 0; i < ids.length; i++)
+						coordinates[i] = { id: ids[i], coordinates: { x: xs[i], y: ys[i] }, text: value.text[i] };
+					result[key] = coordinates;
+				} else
+					console.log("warning: unknown typed value '" + value.typed + "' in view '" + viewId + "'");
+			}
+		}
+	}
+	if (variants) {
+		for (var variantId in response)
+			decodeViews(response[variantId]);
+	} else
+		decodeViews(response);
+	return response;
+}
+
+/*
+ * Post a query to the backend. Returns a promise for the response. Uses the
+ * compact typed array response format if the typedResponses frontend setting
+ * is set, and otherwise plain JSON. Variants must be set for a query with
+ * variants, for decoding the typed format.
+ */
+function _postQuery(backendUrl, queryJson, variants) {
+	if (typeof FrontendConfig.typedResponses == 'undefined' || !FrontendConfig.typedResponses)
+		return $.post(backendUrl, queryJson, null, 'json');
+	var deferred = $.Deferred();
+	var xhr = new XMLHttpRequest();
+	xhr.open('POST', backendUrl + (backendUrl.indexOf('?') >= 0 ? '&' : '?') + 'format=typed');
+	xhr.responseType = 'arraybuffer';
+	xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded; charset=UTF-8');
+	xhr.onload = function () {
+		if (xhr.status == 200)
+			deferred.resolve(_decodeTypedResponse(xhr.response, variants));
+		else
+			deferred.reject(xhr);
+	};
+	xhr.onerror = function () {
+		deferred.reject(xhr);
+	};
+	xhr.send(queryJson);
+	return deferred.promise();
+}
+
+/*
+ * Checks whether a stage of a progressive response has estimated view results.
+ */
+function _hasEstimates(response) {
+	for (var viewId in response)
+		if (response[viewId].hasOwnProperty('estimate'))
+			return true;
+	return false;
+}
+
+/*
+ * Post a query asking for progressive results to the backend. The response
+ * arrives in stages, one line of JSON each: estimated results for some views,
+ * which are passed to onEstimate as soon as they arrive, and then the full
+ * response. Returns a promise for the full response.
+ */
+function _postProgressiveQuery(backendUrl, queryJson, onEstimate) {
+	var deferred = $.Deferred();
+	var xhr = new XMLHttpRequest();
+	var parsedLength = 0, response = null;
+	function parseStages() {
+		var text = xhr.responseText, end;
+		while ((end = text.indexOf('\n', parsedLength)) >= 0) {
+			var stage = JSON.parse(text.substring(parsedLength, end));
+			parsedLength = end + 1;
+			if (_hasEstimates(stage))
+				onEstimate(stage);
+			else
+				response = stage;
+		}
+	}
+	xhr.open('POST', backendUrl);
+	xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded; charset=UTF-8');
+	xhr.onprogress = parseStages;
+	xhr.onload = function () {
+		if (xhr.status == 200) {
+			parseStages();
+			deferred.resolve(response);
+		} else
+			deferred.reject(xhr);
+	};
+	xhr.onerror = function () {
+		deferred.reject(xhr);
+	};
+	xhr.send(queryJson);
+	return deferred.promise();
+}
+
 /*
  * Watcher for constraint changes on a query or an individual constraint.
  *
@@ -355,6 +492,27 @@ function Continuer(query, resultWatcher, limitLocalViewIds, initialResultForWatc
 		if (viewResponse['more'] == true)
 			this._haveMore = true;
 	}
+
+	// Cursors to continue views from, keyed by global view ID
+	this._cursors = {};
+	this._noteCursors(initialResultForWatcher);
+}
+
+/*
+ * Remembers the cursors given in view results, so that the next page of those
+ * views is asked for after the cursor rather than by page number.
+ */
+Continuer.prototype._noteCursors = function(result) {
+	for (var localViewId in result) {
+		var view = this._resultWatcher._value[localViewId];
+		if (view != null && viewUniqueValues.hasOwnProperty(view)) {
+			var globalViewId = viewUniqueValues[view].id;
+			if (result[localViewId].hasOwnProperty('cursor'))
+				this._cursors[globalViewId] = result[localViewId].cursor;
+			else
+				delete this._cursors[globalViewId];
+		}
+	}
 }
 
 /*
@@ -375,12 +533,16 @@ Continuer.prototype.fetchNext = function(callback) {
 	var cnstrsJson = this._query._getConstraintsJSON();
 	var viewsJson = this._query._getViewsJSON(this._parts, function (localViewId, globalViewId, view) {
 		view = JSON.parse(view);
-		view.page = (view.page || 0) + contr._pageOffset;
+		if (contr._cursors.hasOwnProperty(globalViewId)) {
+			delete view.page;
+			view.cursor = contr._cursors[globalViewId];
+		} else
+			view.page = (view.page || 0) + contr._pageOffset;
 		return JSON.stringify(view);
 	});
 	var queryJson = '{"constraints":' + cnstrsJson + ',"views":' + viewsJson + '}';
 
-	$.post(this._query._backendUrl, queryJson, 'json').done(function(response) {
+	_postQuery(this._query._backendUrl, queryJson).done(function(response) {
 		contr._haveMore = false;
 		_resultsForResultWatchers({ 0: contr._resultWatcher }, response, true, function (watcher, result) {
 			for (var localViewId in result)
@@ -388,6 +550,7 @@ Continuer.prototype.fetchNext = function(callback) {
 					contr._haveMore = true;
 					break;
 				}
+			contr._noteCursors(result);
 			callback(result);
 		});
 		contr._pageOffset++;
@@ -770,9 +933,84 @@ Query.prototype._getViewsJSON = function(resultWatchers, viewRewriter) {
 	return jsonStr;
 }
 
+/*
+ * Start an update: work out which result watchers need new results and mark
+ * the query as up to date. Returns null if nothing needs to be asked of the
+ * backend, and otherwise the update, with the JSON for the views needed and
+ * the result watchers to pass the results to (see _finishUpdate()).
+ */
+Query.prototype._startUpdate = function () {
+	var query = this;
+	if (!query._someConstraintChangedSinceUpdate && !query._someResultWatcherChangedSinceUpdate)
+		return null;
+
+	var resultWatchersToUpdate = {};
+	var toForceResolve = {};
+	for (var watcherId in query._resultWatchers) {
+		var watcher = query._resultWatchers[watcherId];
+		if (query._someConstraintChangedSinceUpdate || query._resultWatchersChangedSinceUpdate[watcher._id])
+			(watcher._value != null ? resultWatchersToUpdate : toForceResolve)[watcher._id] = watcher;
+	}
+
+	// We resolve any errors on watchers that are no longer active, because otherwise they are stuck in an error state
+	var currentResultWatchersWithErrors = {};
+	for (var watcherId in this._resultWatchersWithErrors)
+		currentResultWatchersWithErrors[watcherId] = this._resultWatchersWithErrors[watcherId];
+	for (var watcherId in toForceResolve)
+		currentResultWatchersWithErrors[watcherId] = false;
+	query._updateErrorResolvedWatchers(currentResultWatchersWithErrors);
+
+	if ($.isEmptyObject(resultWatchersToUpdate))
+		return null;
+
+	var update = {
+		viewsJson: query._getViewsJSON(resultWatchersToUpdate),
+		resultWatchers: resultWatchersToUpdate
+	};
+	query._someConstraintChangedSinceUpdate = false;
+	query._someResultWatcherChangedSinceUpdate = false;
+	query._resultWatchersChangedSinceUpdate = {};
+	return update;
+}
+
+/*
+ * Finish an update started with _startUpdate(), passing the results in the
+ * backend response to the result watchers.
+ */
+Query.prototype._finishUpdate = function (update, response) {
+	var query = this;
+	var currentResultWatchersWithErrors = {};
+	_resultsForResultWatchers(update.resultWatchers, response, true, function (watcher, result) {
+		watcher._callback(result, function (limitLocalViewIds) {
+			return new Continuer(query, watcher, limitLocalViewIds, result);
+		});
+	}, function (message, watcher) {
+		query._updateErrorWatchers(message, false, watcher);
+		currentResultWatchersWithErrors[watcher._id] = true;
+	});
+	query._updateErrorResolvedWatchers(currentResultWatchersWithErrors);
+}
+
+/*
+ * Pass estimated results from a progressive response for an update started
+ * with _startUpdate() to the result watchers whose views were all estimated.
+ * Their callbacks are called again with the exact results when those arrive
+ * (in _finishUpdate()), so they can refine what they show in place.
+ */
+Query.prototype._estimateUpdate = function (update, response) {
+	var query = this;
+	_resultsForResultWatchers(update.resultWatchers, response, true, function (watcher, result) {
+		watcher._callback(result, function (limitLocalViewIds) {
+			return new Continuer(query, watcher, limitLocalViewIds, result);
+		});
+	}, null);
+}
+
 /*
  * Trigger an update, asking the backend for all needed results and passing the
- * results (when they arrive) off to the result watchers.
+ * results (when they arrive) off to the result watchers. If the
+ * progressiveResults frontend setting is set, estimated results are passed on
+ * first for large queries.
  */
 Query.prototype.update = function(postponeFinish) {
 	var query = this;
@@ -780,60 +1018,47 @@ Query.prototype.update = function(postponeFinish) {
 	// We only go the backend if something changed and there is at least one view that needs updating.
 	var startTime = (new Date()).getTime();
 	var finish = null;
-	if (query._someConstraintChangedSinceUpdate || query._someResultWatcherChangedSinceUpdate) {
-		var resultWatchersToUpdate = {};
-		var toForceResolve = {};
-		for (var watcherId in query._resultWatchers) {
-			var watcher = query._resultWatchers[watcherId];
-			if (query._someConstraintChangedSinceUpdate || query._resultWatchersChangedSinceUpdate[watcher._id])
-				(watcher._value != null ? resultWatchersToUpdate : toForceResolve)[watcher._id] = watcher;
-		}
-
-		// We resolve any errors on watchers that are no longer active, because otherwise they are stuck in an error state
-		var currentResultWatchersWithErrors = {};
-		for (var watcherId in this._resultWatchersWithErrors)
-			currentResultWatchersWithErrors[watcherId] = this._resultWatchersWithErrors[watcherId];
-		for (var watcherId in toForceResolve)
-			currentResultWatchersWithErrors[watcherId] = false;
-		query._updateErrorResolvedWatchers(currentResultWatchersWithErrors);
-
-		if (!$.isEmptyObject(resultWatchersToUpdate)) {
-			var queryJson = '{"constraints":' + query._getConstraintsJSON() + ',"views":' + query._getViewsJSON(resultWatchersToUpdate) + '}';
-			if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('outgoingQuery') && FrontendConfig.verboseLog.outgoingQuery)
-				console.log("outgoing query", query._id, queryJson);
-			var sendTime = (new Date()).getTime();
-			var post = $.post(query._backendUrl, queryJson, null, 'json');
-			query._someConstraintChangedSinceUpdate = false;
-			query._someResultWatcherChangedSinceUpdate = false;
-			query._resultWatchersChangedSinceUpdate = {};
-			finish = function () {
-				post.done(function (response) {
-					var replyTime = (new Date()).getTime();
-					if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('incomingReply') && FrontendConfig.verboseLog.incomingReply)
-						console.log("incoming reply", query._id, response);
-					var currentResultWatchersWithErrors = {};
-					_resultsForResultWatchers(resultWatchersToUpdate, response, true, function (watcher, result) {
-						watcher._callback(result, function (limitLocalViewIds) {
-							return new Continuer(query, watcher, limitLocalViewIds, result);
-						});
-					}, function (message, watcher) {
-						query._updateErrorWatchers(message, false, watcher);
-						currentResultWatchersWithErrors[watcher._id] = true;
-					});
-					query._updateErrorResolvedWatchers(currentResultWatchersWithErrors);
-					var doneTime = (new Date()).getTime();
-					if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('queryTiming') && FrontendConfig.verboseLog.queryTiming)
-						console.log("query timing", "prepare", (sendTime - startTime) / 1000, "wait on backend", (replyTime - sendTime) / 1000, "handle", (doneTime - replyTime) / 1000, "total", (doneTime - startTime) / 1000);
-				});
-			}
+	var update = query._startUpdate();
+	if (update != null) {
+		var progressive = typeof FrontendConfig.progressiveResults != 'undefined' && FrontendConfig.progressiveResults;
+		var queryJson = '{"constraints":' + query._getConstraintsJSON() + ',"views":' + update.viewsJson + (progressive ? ',"progressive":true' : '') + '}';
+		if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('outgoingQuery') && FrontendConfig.verboseLog.outgoingQuery)
+			console.log("outgoing query", query._id, queryJson);
+		var sendTime = (new Date()).getTime();
+		var post;
+		if (progressive) {
+			post = _postProgressiveQuery(query._backendUrl, queryJson, function (estimate) {
+				if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('incomingReply') && FrontendConfig.verboseLog.incomingReply)
+					console.log("incoming estimate", query._id, estimate);
+				query._estimateUpdate(update, estimate);
+			});
+		} else
+			post = _postQuery(query._backendUrl, queryJson);
+		finish = function () {
+			post.done(function (response) {
+				var replyTime = (new Date()).getTime();
+				if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('incomingReply') && FrontendConfig.verboseLog.incomingReply)
+					console.log("incoming reply", query._id, response);
+				query._finishUpdate(update, response);
+				var doneTime = (new Date()).getTime();
+				if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('queryTiming') && FrontendConfig.verboseLog.queryTiming)
+					console.log("query timing", "prepare", (sendTime - startTime) / 1000, "wait on backend", (replyTime - sendTime) / 1000, "handle", (doneTime - replyTime) / 1000, "total", (doneTime - startTime) / 1000);
+			});
 		}
 	}
 	if (finish == null)
 		finish = function () {};
 
+	// Context queries (this query less some constraints) are batched into a
+	// single request if possible, and other derived queries update themselves
+	var batchedChildren = [];
 	$.each(this._childrenToUpdate, function (childId, child) {
-		child.update();
+		if (FrontendConfig.batchContextQueries && child._type == 'setminus' && child._parents[0] === query)
+			batchedChildren.push(child);
+		else
+			child.update();
 	});
+	query._updateChildrenBatched(batchedChildren);
 
 	if (postponeFinish)
 		return finish;
@@ -841,6 +1066,45 @@ Query.prototype.update = function(postponeFinish) {
 		finish();
 }
 
+/*
+ * Update setminus queries derived from this one (this query less the
+ * constraints of some other query) in a single backend request. Each is sent
+ * as a variant of this query's constraints leaving out the constraints the
+ * derived query doesn't have, which the backend evaluates together.
+ */
+Query.prototype._updateChildrenBatched = function (children) {
+	var query = this;
+	var updates = [];
+	var variantsJson = [];
+	for (var i = 0; i < children.length; i++) {
+		var child = children[i];
+		var update = child._startUpdate();
+		if (update != null) {
+			var exclude = [];
+			for (var cnstrId in query._constraints)
+				if (query._constraints[cnstrId]._value != null && !child._constraints.hasOwnProperty(cnstrId))
+					exclude.push(cnstrId);
+			variantsJson.push('"' + child._id + '":{"exclude":' + JSON.stringify(exclude) + ',"views":' + update.viewsJson + '}');
+			updates.push({ child: child, update: update });
+		}
+		$.each(child._childrenToUpdate, function (grandchildId, grandchild) {
+			grandchild.update();
+		});
+	}
+	if (updates.length == 0)
+		return;
+
+	var queryJson = '{"constraints":' + query._getConstraintsJSON() + ',"variants":{' + variantsJson.join(",") + '}}';
+	if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('outgoingQuery') && FrontendConfig.verboseLog.outgoingQuery)
+		console.log("outgoing batched context query", query._id, queryJson);
+	_postQuery(query._backendUrl, queryJson, true).done(function (response) {
+		if (typeof FrontendConfig.verboseLog != 'undefined' && FrontendConfig.verboseLog.hasOwnProperty('incomingReply') && FrontendConfig.verboseLog.incomingReply)
+			console.log("incoming batched context reply", query._id, response);
+		for (var i = 0; i < updates.length; i++)
+			updates[i].child._finishUpdate(updates[i].update, response[updates[i].child._id]);
+	});
+}
+
 return {
 	ChangeWatcher: ChangeWatcher,
 	ResultWatcher: ResultWatcher,
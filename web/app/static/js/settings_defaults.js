@@ -4,3 +4,12 @@
 
 // URL for the backend.
 FrontendConfig.backendUrl = "http://localhost:1500";
+
+// Ask the backend for responses in its compact typed array format rather than plain JSON.
+FrontendConfig.typedResponses = false;
+
+// Send the context queries of all tabs (the global query less each tab's own constraints) to the backend together in one request.
+FrontendConfig.batchContextQueries = true;
+
+// Ask the backend for progressive results, so that large queries first show counts estimated from a sample of the matching events and then the exact counts.
+FrontendConfig.progressiveResults = false;